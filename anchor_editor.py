@@ -1,5 +1,10 @@
 import os
+import math
 import json
+import queue
+import threading
+import numpy as np
+from collections import OrderedDict
 from tkinter import (
     Tk, Canvas, Button, Frame,
     filedialog, Entry, LEFT, RIGHT,
@@ -7,6 +12,8 @@ from tkinter import (
 )
 from PIL import Image, ImageTk, ImageDraw, ImageFilter
 
+from create import font_index, list_glyphs
+
 
 WINDOW_WIDTH = 1100
 WINDOW_HEIGHT = 820
@@ -14,6 +21,82 @@ WINDOW_HEIGHT = 820
 CANVAS_WIDTH = 1000
 CANVAS_HEIGHT = 600
 
+PREFETCH_RADIUS = 3        # сколько соседних букв готовить в каждую сторону
+PREFETCH_CACHE_SIZE = 16   # максимум декодированных букв в памяти
+OPEN_SCALE = 1.0           # масштаб, с которым открывается каждая буква
+
+# цвета якорей: ручные и кандидаты из auto_anchors.py ("auto": true)
+ANCHOR_COLORS = {
+    "entry": (0, 255, 0, 255),
+    "exit": (255, 0, 0, 255),
+}
+AUTO_ANCHOR_COLORS = {
+    "entry": (0, 200, 255, 255),
+    "exit": (255, 170, 0, 255),
+}
+
+
+def pyramid_level(pyramid, scale):
+    """Самый мелкий уровень пирамиды (каждый вдвое меньше), который
+    ещё не мельче масштаба scale. Уровни достраиваются по запросу."""
+    level = 0
+    while scale <= 0.5 ** (level + 1):
+        level += 1
+        if level == len(pyramid):
+            prev = pyramid[-1]
+            if min(prev.size) < 2:
+                return level - 1
+            pyramid.append(prev.reduce(2))
+    return level
+
+
+def centered_offset(img, scale):
+    return [(CANVAS_WIDTH - int(img.width * scale)) // 2,
+            (CANVAS_HEIGHT - int(img.height * scale)) // 2]
+
+
+def visible_part(pyramid, scale, offset):
+    """Видимая на canvas часть глифа, уже отмасштабированная:
+    (изображение, x, y) или None, если глиф за пределами canvas."""
+    img = pyramid[0]
+    x_offset, y_offset = offset
+
+    # масштабируем только видимую на canvas часть изображения
+    src = pyramid[pyramid_level(pyramid, scale)]
+    k = src.width / img.width
+
+    x0 = max(0.0, -x_offset / scale)
+    y0 = max(0.0, -y_offset / scale)
+    x1 = min(img.width, (CANVAS_WIDTH - x_offset) / scale)
+    y1 = min(img.height, (CANVAS_HEIGHT - y_offset) / scale)
+
+    sx0, sy0 = int(x0 * k), int(y0 * k)
+    sx1 = min(src.width, math.ceil(x1 * k))
+    sy1 = min(src.height, math.ceil(y1 * k))
+
+    if sx1 <= sx0 or sy1 <= sy0:
+        return None
+
+    crop = src.crop((sx0, sy0, sx1, sy1))
+    ratio = scale / k
+
+    scaled = crop.resize(
+        (max(1, round(crop.width * ratio)),
+         max(1, round(crop.height * ratio))),
+        Image.LANCZOS
+    )
+    return scaled, x_offset + sx0 * ratio, y_offset + sy0 * ratio
+
+
+def prepare_letter(path):
+    """Запись кэша: пирамида и видимая часть глифа, отмасштабированная
+    под canvas так, как буква показывается при открытии."""
+    img = Image.open(path).convert("RGBA")
+    pyramid = [img]
+    offset = centered_offset(img, OPEN_SCALE)
+    view = visible_part(pyramid, OPEN_SCALE, offset)
+    return {"pyramid": pyramid, "view": ((OPEN_SCALE, tuple(offset)), view)}
+
 
 class AnchorEditor:
 
@@ -32,12 +115,22 @@ class AnchorEditor:
         self.anchors = {}
 
         self.original_image = None
+        self.loaded_path = None
+        self.pyramid = []
+        self.prepared_view = None   # ((масштаб, смещение), видимая часть)
         self.tk_image = None
-        self.glow_images = []
+        self.glow_sprites = {}
+
+        # кэш декодированных букв: path -> запись prepare_letter
+        self.image_cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.prefetch_queue = queue.Queue()
+        self.generation = 0         # растёт при смене папки
+        threading.Thread(target=self.prefetch_worker, daemon=True).start()
 
         self.image_offset = [0, 0]
 
-        self.scale = 1.0
+        self.scale = OPEN_SCALE
         self.min_scale = 0.2
         self.max_scale = 5.0
 
@@ -57,6 +150,9 @@ class AnchorEditor:
         Button(self.top, text="Сохранить",
                command=self.save_anchors).pack(side=LEFT, padx=10)
 
+        Button(self.top, text="Принять кандидата (↓)",
+               command=self.accept_candidate).pack(side=LEFT, padx=10)
+
         # Переключатель темы
         self.theme_frame = Frame(self.top)
         self.theme_frame.pack(side=RIGHT, padx=20)
@@ -125,6 +221,7 @@ class AnchorEditor:
 
         self.root.bind("<Left>", lambda e: self.prev_letter())
         self.root.bind("<Right>", lambda e: self.next_letter())
+        self.root.bind("<Down>", lambda e: self.accept_candidate())
 
     # ================= ТЕМА =================
 
@@ -205,34 +302,22 @@ class AnchorEditor:
         center = size // 2
         radius = 24
 
-        img = Image.new("RGBA", (size, size), (0, 0, 0, 0))
-        pixels = img.load()
-
         r_col, g_col, b_col, _ = color
 
-        for y in range(size):
-            for x in range(size):
-                dx = x - center
-                dy = y - center
-                dist = (dx * dx + dy * dy) ** 0.5
+        yy, xx = np.mgrid[0:size, 0:size]
+        dist = np.hypot(xx - center, yy - center)
 
-                if dist <= radius:
+        # более агрессивный профиль яркости, центр намного ярче
+        intensity = np.clip(1 - dist / radius, 0, 1) ** 2.4
 
-                    # более агрессивный профиль яркости
-                    intensity = 1 - (dist / radius)
+        # усиливаем цвет
+        boost = 2.2
+        rgba = np.zeros((size, size, 4), np.uint8)
+        for i, c in enumerate((r_col, g_col, b_col)):
+            rgba[..., i] = np.minimum(255, c * intensity * boost)
+        rgba[..., 3] = np.minimum(255, 255 * intensity * 1.6)
 
-                    # делаем центр намного ярче
-                    intensity = intensity ** 2.4
-
-                    # усиливаем цвет
-                    boost = 2.2
-                    r = min(255, int(r_col * intensity * boost))
-                    g = min(255, int(g_col * intensity * boost))
-                    b = min(255, int(b_col * intensity * boost))
-
-                    alpha = min(255, int(255 * intensity * 1.6))
-
-                    pixels[x, y] = (r, g, b, alpha)
+        img = Image.fromarray(rgba, "RGBA")
 
         # лёгкое bloom-размытие
         img = img.filter(ImageFilter.GaussianBlur(3))
@@ -247,6 +332,12 @@ class AnchorEditor:
 
         return ImageTk.PhotoImage(img)
 
+    def get_glow(self, color):
+        # спрайт одного цвета строится один раз за сессию
+        if color not in self.glow_sprites:
+            self.glow_sprites[color] = self.create_glow_image(color)
+        return self.glow_sprites[color]
+
     def draw_existing_anchors(self):
 
         name = self.letters[self.index]["name"]
@@ -255,21 +346,25 @@ class AnchorEditor:
 
         x_offset, y_offset = self.image_offset
         data = self.anchors[name]
+        auto = data.get("auto", False)
+        colors = AUTO_ANCHOR_COLORS if auto else ANCHOR_COLORS
 
-        self.glow_images = []
-
-        for t, color in [("entry", (0, 255, 0, 255)),
-                         ("exit", (255, 0, 0, 255))]:
+        for t in ("entry", "exit"):
 
             if t in data:
                 x, y = data[t]
                 x = x * self.scale + x_offset
                 y = y * self.scale + y_offset
 
-                glow = self.create_glow_image(color)
-                self.glow_images.append(glow)
+                self.canvas.create_image(x, y, image=self.get_glow(colors[t]))
 
-                self.canvas.create_image(x, y, image=glow)
+                # кандидат дополнительно обводится пунктиром
+                if auto:
+                    self.canvas.create_oval(
+                        x - 18, y - 18, x + 18, y + 18,
+                        outline="#%02x%02x%02x" % colors[t][:3],
+                        dash=(4, 3), width=2
+                    )
 
     # ================= Остальной функционал =================
 
@@ -279,20 +374,30 @@ class AnchorEditor:
             return
 
         self.font_dir = folder
+
+        # всё подготовленное для старой папки больше не годится,
+        # в том числе то, что фоновый поток дочитывает прямо сейчас
+        self.generation += 1
+        self.drain_prefetch_queue()
+        with self.cache_lock:
+            self.image_cache.clear()
+        self.loaded_path = None
+
         self.load_letters()
         self.load_existing_anchors()
 
         self.index = 0
-        self.scale = 1.0
+        self.scale = OPEN_SCALE
+        self.image_offset = [0, 0]
         self.show_letter()
 
     def load_letters(self):
-        self.letters = []
-        for f in sorted(os.listdir(self.font_dir)):
-            if f.lower().endswith(".png"):
-                name = os.path.splitext(f)[0]
-                path = os.path.join(self.font_dir, f)
-                self.letters.append({"name": name, "path": path})
+        # имена берутся из manifest.json, если файлы ещё номерные
+        font_index.cache_clear()
+        self.letters = [
+            {"name": name, "path": path}
+            for name, path in list_glyphs(self.font_dir)
+        ]
 
     def load_existing_anchors(self):
         json_path = os.path.join(self.font_dir, "anchors.json")
@@ -302,6 +407,71 @@ class AnchorEditor:
         else:
             self.anchors = {}
 
+    # ================= Кэш и фоновая подгрузка =================
+
+    def cache_put(self, path, entry):
+        with self.cache_lock:
+            self.image_cache[path] = entry
+            self.image_cache.move_to_end(path)
+            while len(self.image_cache) > PREFETCH_CACHE_SIZE:
+                self.image_cache.popitem(last=False)
+
+    def cache_get(self, path):
+        with self.cache_lock:
+            entry = self.image_cache.get(path)
+            if entry is not None:
+                self.image_cache.move_to_end(path)
+            return entry
+
+    def prefetch_worker(self):
+        # декодирование и масштабирование идут в фоне;
+        # PhotoImage создаётся только в UI-потоке
+        while True:
+            path, generation = self.prefetch_queue.get()
+            if generation != self.generation or self.cache_get(path) is not None:
+                continue
+            try:
+                entry = prepare_letter(path)
+            except OSError:
+                continue
+            # пока готовили, папку сменили — результат не нужен
+            if generation == self.generation:
+                self.cache_put(path, entry)
+
+    def drain_prefetch_queue(self):
+        while True:
+            try:
+                self.prefetch_queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def schedule_prefetch(self):
+        # старые заявки больше не актуальны
+        self.drain_prefetch_queue()
+
+        for d in range(1, PREFETCH_RADIUS + 1):
+            for i in (self.index + d, self.index - d):
+                if 0 <= i < len(self.letters):
+                    self.prefetch_queue.put(
+                        (self.letters[i]["path"], self.generation)
+                    )
+
+    def load_letter_image(self, letter):
+        # PNG декодируется только при смене буквы, а не на каждый клик/zoom
+        if self.loaded_path != letter["path"]:
+            entry = self.cache_get(letter["path"])
+            if entry is None:
+                entry = prepare_letter(letter["path"])
+                self.cache_put(letter["path"], entry)
+
+            self.pyramid = entry["pyramid"]
+            self.original_image = self.pyramid[0]
+            self.prepared_view = entry["view"]
+            self.loaded_path = letter["path"]
+            self.schedule_prefetch()
+
+        return self.original_image
+
     def show_letter(self):
 
         if not self.letters:
@@ -314,30 +484,26 @@ class AnchorEditor:
 
         self.canvas.delete("all")
 
-        img = Image.open(letter["path"]).convert("RGBA")
-        self.original_image = img
-
-        scaled = img.resize(
-            (int(img.width * self.scale),
-             int(img.height * self.scale)),
-            Image.LANCZOS
-        )
-
-        self.tk_image = ImageTk.PhotoImage(scaled)
+        img = self.load_letter_image(letter)
 
         # если первый раз — центрируем
         if self.image_offset == [0, 0]:
-            self.image_offset[0] = (CANVAS_WIDTH - scaled.width) // 2
-            self.image_offset[1] = (CANVAS_HEIGHT - scaled.height) // 2
+            self.image_offset = centered_offset(img, self.scale)
 
-        x_offset, y_offset = self.image_offset
+        # при открытии буквы видимая часть обычно уже отмасштабирована
+        # в фоне; после zoom считается заново
+        key = (self.scale, tuple(self.image_offset))
+        if self.prepared_view is not None and self.prepared_view[0] == key:
+            part = self.prepared_view[1]
+        else:
+            part = visible_part(self.pyramid, self.scale, self.image_offset)
 
-        self.canvas.create_image(
-            x_offset,
-            y_offset,
-            anchor="nw",
-            image=self.tk_image
-        )
+        self.tk_image = None
+
+        if part is not None:
+            scaled, x, y = part
+            self.tk_image = ImageTk.PhotoImage(scaled)
+            self.canvas.create_image(x, y, anchor="nw", image=self.tk_image)
 
         self.draw_existing_anchors()
 
@@ -368,20 +534,36 @@ class AnchorEditor:
                 float(real_x),
                 float(real_y)
             ]
+            # глиф просмотрен: второй якорь-кандидат остаётся как принятый
+            self.anchors[name].pop("auto", None)
 
             self.show_letter()
 
+    def accept_candidate(self):
+        """Принимает якоря-кандидаты текущего глифа и переходит к следующему."""
+        if not self.letters:
+            return
+
+        data = self.anchors.get(self.letters[self.index]["name"])
+        if data:
+            data.pop("auto", None)
+
+        if self.index < len(self.letters) - 1:
+            self.next_letter()
+        else:
+            self.show_letter()
+
     def next_letter(self):
         if self.index < len(self.letters) - 1:
             self.index += 1
-            self.scale = 1.0
+            self.scale = OPEN_SCALE
             self.image_offset = [0, 0]
             self.show_letter()
 
     def prev_letter(self):
         if self.index > 0:
             self.index -= 1
-            self.scale = 1.0
+            self.scale = OPEN_SCALE
             self.image_offset = [0, 0]
             self.show_letter()
 
@@ -390,7 +572,7 @@ class AnchorEditor:
         for i, l in enumerate(self.letters):
             if l["name"] == name:
                 self.index = i
-                self.scale = 1.0
+                self.scale = OPEN_SCALE
                 self.show_letter()
                 break
 
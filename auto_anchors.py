@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+auto_anchors.py — черновые якоря entry/exit для всех глифов шрифта.
+
+  python auto_anchors.py                      # все папки letters/*/*
+  python auto_anchors.py letters/russian/font3
+
+Маска глифа утончается до скелета; entry — самая левая и низкая точка
+скелета в нижней половине глифа, exit — самая правая и низкая, обе
+притягиваются к ближайшему концу штриха. Найденные
+точки пишутся в anchors.json с пометкой "auto": true только для глифов
+без ручных якорей; AnchorEditor показывает их отдельно, чтобы человек
+принял или поправил кандидата.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import cv2
+
+from create import LETTERS_DIR, font_index, list_glyphs, open_glyph
+
+
+# ============================================================
+# НАСТРОЙКИ
+# ============================================================
+ANCHORS_NAME = "anchors.json"
+ALPHA_THRESHOLD = 128
+LOWER_PART = 0.5      # кандидаты ищутся ниже этой доли высоты глифа
+LOW_BIAS = 1.0        # насколько сильно entry/exit тянутся вниз, к строке
+SNAP_TO_END = 0.1     # притяжение к концу штриха, доля ширины глифа
+MAX_THINNING_ITER = 200
+
+
+# ============================================================
+# СКЕЛЕТ
+# ============================================================
+def neighbours(img):
+    """Соседи P2..P9 каждого пикселя (по часовой, начиная сверху)."""
+    p = np.pad(img, 1)
+    return [
+        p[:-2, 1:-1], p[:-2, 2:], p[1:-1, 2:], p[2:, 2:],
+        p[2:, 1:-1], p[2:, :-2], p[1:-1, :-2], p[:-2, :-2],
+    ]
+
+
+def thin(mask):
+    """Утончение Чжана — Суэня, все пиксели шага обрабатываются разом."""
+    img = (mask > 0).astype(np.uint8)
+
+    for _ in range(MAX_THINNING_ITER):
+        changed = False
+        for step in (0, 1):
+            P2, P3, P4, P5, P6, P7, P8, P9 = n = neighbours(img)
+            B = sum(n)
+            seq = n + [P2]
+            A = sum((seq[i] == 0) & (seq[i + 1] == 1) for i in range(8))
+
+            if step == 0:
+                c1 = P2 * P4 * P6 == 0
+                c2 = P4 * P6 * P8 == 0
+            else:
+                c1 = P2 * P4 * P8 == 0
+                c2 = P2 * P6 * P8 == 0
+
+            remove = (img == 1) & (B >= 2) & (B <= 6) & (A == 1) & c1 & c2
+            if remove.any():
+                img[remove] = 0
+                changed = True
+
+        if not changed:
+            break
+
+    return img
+
+
+def endpoints(skel):
+    """Концы штрихов: пиксели скелета ровно с одним соседом."""
+    count = cv2.filter2D(skel, -1, np.ones((3, 3), np.float32),
+                         borderType=cv2.BORDER_CONSTANT) - skel
+    ys, xs = np.nonzero((skel == 1) & (count == 1))
+    return xs, ys
+
+
+# ============================================================
+# ЯКОРЯ
+# ============================================================
+def glyph_anchors(path):
+    """{"entry": [x, y], "exit": [x, y]} по маске глифа или None."""
+    alpha = np.asarray(open_glyph(path))[:, :, 1]
+    mask = alpha >= ALPHA_THRESHOLD
+    if not mask.any():
+        return None
+
+    skel = thin(mask)
+    h, w = skel.shape
+    ys, xs = np.nonzero(skel)
+    ends_x, ends_y = endpoints(skel)
+
+    # соединения идут по строке: кандидаты — скелет в нижней части глифа
+    lower = ys >= LOWER_PART * h
+    if lower.sum() >= 2:
+        xs, ys = xs[lower], ys[lower]
+
+    # чем левее и ниже, тем лучше для entry; правее и ниже — для exit
+    low = LOW_BIAS * ys / h
+    picks = (int(np.argmin(xs / w - low)), int(np.argmax(xs / w + low)))
+
+    result = {}
+    for name, i in zip(("entry", "exit"), picks):
+        x, y = xs[i], ys[i]
+        # рядом есть конец штриха — якорь ставится на него
+        if len(ends_x):
+            d = np.hypot(ends_x - x, ends_y - y)
+            j = int(np.argmin(d))
+            if d[j] < SNAP_TO_END * w:
+                x, y = ends_x[j], ends_y[j]
+        result[name] = [float(x), float(y)]
+
+    return result
+
+
+def load_anchors(font_dir):
+    path = os.path.join(font_dir, ANCHORS_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_anchors(font_dir, anchors):
+    path = os.path.join(font_dir, ANCHORS_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(anchors, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def process_font(font_dir):
+    """Дописывает кандидатов в anchors.json; ручные якоря не трогает."""
+    font_index.cache_clear()
+    anchors = load_anchors(font_dir)
+
+    added = 0
+    for key, path in list_glyphs(font_dir):
+        current = anchors.get(key)
+        if current and not current.get("auto"):
+            continue
+
+        found = glyph_anchors(path)
+        if found is None:
+            continue
+
+        found["auto"] = True
+        anchors[key] = found
+        added += 1
+
+    if added:
+        write_anchors(font_dir, anchors)
+    return added, len(anchors)
+
+
+def font_dirs(root=LETTERS_DIR):
+    return sorted(
+        os.path.join(root, cat, font)
+        for cat in os.listdir(root)
+        if os.path.isdir(os.path.join(root, cat))
+        for font in os.listdir(os.path.join(root, cat))
+        if os.path.isdir(os.path.join(root, cat, font))
+    )
+
+
+# ============================================================
+# MAIN
+# ============================================================
+def main():
+    parser = argparse.ArgumentParser(description="Черновые якоря глифов")
+    parser.add_argument("fonts", nargs="*", help="папки шрифтов (по умолчанию все)")
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    for font_dir in args.fonts or font_dirs():
+        added, total = process_font(font_dir)
+        print(f"{font_dir:<28} кандидатов: {added:>4}, всего якорей: {total}")
+    print(f"Готово за {time.perf_counter() - t:.1f} с")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
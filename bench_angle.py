@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+bench_angle.py — сравнение оценщиков наклона сетки (Hough / projection).
+
+  python bench_angle.py IMG/4.jpg IMG/6.jpg [--rotate 1.5]
+
+Для каждого листа строится та же маска сетки, что и в detect_grid,
+затем оба оценщика запускаются по нескольку раз. --rotate дополнительно
+поворачивает лист на заданный угол, чтобы проверить согласие на
+заведомо наклонённом скане.
+"""
+
+import sys
+import time
+import argparse
+import cv2
+
+import detect_grid as dg
+
+
+def prepare_mask(path, rotate=0.0):
+    img = dg.load_image_cv(path)
+    if rotate:
+        H, W = img.shape[:2]
+        M = cv2.getRotationMatrix2D((W // 2, H // 2), rotate, 1.0)
+        img = cv2.warpAffine(img, M, (W, H), borderValue=(255, 255, 255))
+
+    horiz, vert = dg.line_masks(img)
+    dpi = dg.choose_dpi(dg.read_dpi(path), dg.estimate_dpi(horiz, vert))
+    min_len_px = int(dg.mm_to_px(dg.MIN_LINE_LEN_CM * 10, dpi))
+    return dg.mask_crop_border(dg.build_grid(horiz, vert, min_len_px))
+
+
+def bench(mask, method, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        angle = dg.estimate_angle(mask, method)
+        best = min(best, time.perf_counter() - t)
+    return angle, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--rotate", type=float, default=0.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'файл':<16}{'метод':<12}{'угол, °':>10}{'время, мс':>12}")
+    for path in args.images:
+        mask = prepare_mask(path, args.rotate)
+        results = {}
+        for method in ("hough", "projection"):
+            angle, sec = bench(mask, method, args.repeat)
+            results[method] = angle
+            print(f"{path:<16}{method:<12}{angle:>10.3f}{sec * 1000:>12.1f}")
+        diff = abs(results["hough"] - results["projection"])
+        print(f"{'':<16}{'Δ':<12}{diff:>10.3f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
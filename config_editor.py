@@ -1,7 +1,16 @@
 import tkinter as tk
 from tkinter import filedialog, Menu
 from PIL import Image, ImageTk
-import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from create import font_index, list_glyphs
+
+
+REDRAW_DEBOUNCE_MS = 30
+RESIZE_CACHE_SIZE = 512
+WARMUP_WORKERS = 4
+WARMUP_POLL_MS = 100
 
 
 class HandFontEditor(tk.Tk):
@@ -14,7 +23,8 @@ class HandFontEditor(tk.Tk):
 
         # --------- STATE ---------
         self.font_folder = None
-        self.letters = {}
+        self.letter_paths = {}   # имя -> путь, индексируется сразу
+        self.letters = {}        # имя -> RGBA, декодируется по требованию
         self.word = "Привет"
         self.show_black = True
 
@@ -22,6 +32,16 @@ class HandFontEditor(tk.Tk):
         self.min_scale = 1.0
         self.line_spacing = 90
 
+        # (буква, ширина, высота) -> PhotoImage
+        self.resize_cache = OrderedDict()
+        # ссылки на картинки текущей сцены, иначе Tk их потеряет
+        self.scene_images = []
+        self.redraw_job = None
+
+        self.loader = ThreadPoolExecutor(max_workers=WARMUP_WORKERS)
+        self.warmup = []
+        self.warmup_job = None
+
         self.build_layout()
         self.draw_scene()
 
@@ -169,17 +189,52 @@ class HandFontEditor(tk.Tk):
         if not folder:
             return
 
-        self.letters.clear()
+        # недогруженный прошлый шрифт больше не нужен
+        for fut in self.warmup:
+            fut.cancel()
+
+        self.font_folder = folder
+        self.letters = {}
+        self.resize_cache.clear()
 
-        for file in os.listdir(folder):
-            if file.endswith(".png"):
-                name = file.replace(".png", "")
-                path = os.path.join(folder, file)
-                img = Image.open(path).convert("RGBA")
-                self.letters[name] = img
+        font_index.cache_clear()
+        self.letter_paths = dict(list_glyphs(folder))
 
+        # буквы текущего слова декодируются в draw_scene,
+        # остальные — в фоне
         self.draw_scene()
 
+        letters = self.letters
+        self.warmup = [
+            self.loader.submit(self.decode_letter, letters, name, path)
+            for name, path in self.letter_paths.items()
+        ]
+        if self.warmup_job is not None:
+            self.after_cancel(self.warmup_job)
+        self.poll_warmup()
+
+    def decode_letter(self, letters, name, path):
+        if name not in letters:
+            letters[name] = Image.open(path).convert("RGBA")
+
+    def get_letter(self, key):
+        img = self.letters.get(key)
+        if img is None and key in self.letter_paths:
+            self.decode_letter(self.letters, key, self.letter_paths[key])
+            img = self.letters[key]
+        return img
+
+    def poll_warmup(self):
+        done = sum(fut.done() for fut in self.warmup)
+        total = len(self.warmup)
+
+        if done < total:
+            self.hints.config(text=f"Загрузка шрифта: {done}/{total}")
+            self.warmup_job = self.after(WARMUP_POLL_MS, self.poll_warmup)
+        else:
+            self.hints.config(text=f"Шрифт загружен: {total} букв.")
+            self.warmup_job = None
+
     def get_letter_key(self, char):
         return char if char.isupper() else char + "l"
 
@@ -197,11 +252,17 @@ class HandFontEditor(tk.Tk):
 
     def update_max(self, value):
         self.max_scale = float(value) / 100
-        self.draw_scene()
+        self.schedule_redraw()
 
     def update_min(self, value):
         self.min_scale = max(float(value) / 100, 0.5)
-        self.draw_scene()
+        self.schedule_redraw()
+
+    def schedule_redraw(self):
+        # при перетаскивании ползунка перерисовываем один раз в конце серии
+        if self.redraw_job is not None:
+            self.after_cancel(self.redraw_job)
+        self.redraw_job = self.after(REDRAW_DEBOUNCE_MS, self.draw_scene)
 
     # =====================================================
     # DRAW
@@ -229,8 +290,8 @@ class HandFontEditor(tk.Tk):
         for char in self.word:
             key = self.get_letter_key(char)
 
-            if key in self.letters:
-                img = self.letters[key]
+            img = self.get_letter(key)
+            if img is not None:
 
                 target_height = self.line_spacing
                 ratio = target_height / img.height
@@ -239,11 +300,8 @@ class HandFontEditor(tk.Tk):
                 new_w = int(img.width * final_scale)
                 new_h = int(img.height * final_scale)
 
-                resized = img.resize((new_w, new_h),
-                                     Image.Resampling.LANCZOS)
-
-                photo = ImageTk.PhotoImage(resized)
-                self.canvas.image = photo
+                photo = self.get_scaled(key, img, new_w, new_h)
+                self.scene_images.append(photo)
 
                 self.canvas.create_image(x, baseline,
                                          image=photo,
@@ -251,7 +309,26 @@ class HandFontEditor(tk.Tk):
 
                 x += new_w + 15
 
+    def get_scaled(self, key, img, new_w, new_h):
+        cache_key = (key, new_w, new_h)
+
+        photo = self.resize_cache.get(cache_key)
+        if photo is None:
+            resized = img.resize((new_w, new_h),
+                                 Image.Resampling.LANCZOS)
+            photo = ImageTk.PhotoImage(resized)
+
+            self.resize_cache[cache_key] = photo
+            if len(self.resize_cache) > RESIZE_CACHE_SIZE:
+                self.resize_cache.popitem(last=False)
+        else:
+            self.resize_cache.move_to_end(cache_key)
+
+        return photo
+
     def draw_scene(self):
+        self.redraw_job = None
+        self.scene_images = []
         self.canvas.delete("all")
         self.draw_lines()
 
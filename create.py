@@ -1,8 +1,19 @@
 import os
+import json
+import math
 import random
 import yaml
 import re
-from PIL import Image, ImageDraw
+import zlib
+import queue
+import threading
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from collections import Counter, deque
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageOps
 from tkinter import Tk, filedialog
 
 # =====================================================
@@ -10,6 +21,7 @@ from tkinter import Tk, filedialog
 # =====================================================
 
 DPI = 1200
+PREVIEW_DPI = 300     # 150 / 300 — быстрый предпросмотр той же разметки
 
 A4_WIDTH_CM = 21.0
 A4_HEIGHT_CM = 29.7
@@ -21,7 +33,42 @@ LINE_THICKNESS_MM = 0.3
 BACKGROUND_COLOR = (255, 255, 255)
 
 LETTERS_DIR = "letters"
+MANIFEST_NAME = "manifest.json"
+ANCHORS_NAME = "anchors.json"
+JOIN_INK = 40         # яркость соединительного штриха в слитном режиме
 OUTPUT_DIR = "output_pages"
+PAGE_WRITE_QUEUE = 1  # готовых страниц в очереди на запись (каждая ~280 МБ)
+PAGE_WRITE_PROCESSES = 0  # >0 — кодировать страницы в процессах через общую память
+PREVIEW_DIR = os.path.join(OUTPUT_DIR, "preview")
+
+# =====================================================
+# КОДИРОВАНИЕ ВЫХОДА
+# =====================================================
+
+OUTPUT_EXT = {"png": ".png", "tiff": ".tif"}
+
+PNG_STRATEGIES = {
+    "default": zlib.Z_DEFAULT_STRATEGY,
+    "filtered": zlib.Z_FILTERED,
+    "huffman": zlib.Z_HUFFMAN_ONLY,
+    "rle": zlib.Z_RLE,
+    "fixed": zlib.Z_FIXED,
+}
+
+TIFF_COMPRESSIONS = ("none", "tiff_lzw", "tiff_adobe_deflate", "group4")
+
+LETTERS_MODES = ("RGBA", "LA", "P", "1")
+PAGE_MODES = ("RGB", "L", "1")
+
+DEFAULT_OUTPUT = {
+    "format": "png",
+    "compress_level": 6,
+    "png_strategy": "default",
+    "tiff_compression": "tiff_lzw",
+    "letters_mode": "RGBA",
+    "page_mode": "RGB",
+    "letters_layer": True,
+}
 
 # =====================================================
 # СИМВОЛЫ
@@ -40,15 +87,45 @@ SYMBOL_NAME_MAP = {
     "\"": "qt", "'": "ap",
 }
 
+# Замены для символов без глифа (режим substitute). Стиль может
+# дополнить или переопределить их в missing_glyph.substitutes
+SUBSTITUTES = {
+    "ё": "е", "Ё": "Е",
+    "“": "\"", "”": "\"", "„": "\"", "«": "\"", "»": "\"",
+    "‘": "'", "’": "'",
+    "—": "-", "–": "-", "−": "-",
+    "…": ".", "×": "*", "÷": "/",
+}
+
+MISSING_MODES = ("substitute", "skip", "box")
+PLACEHOLDER_CHAR = "\ufffd"   # им в тексте помечаются символы без глифа (box)
+PLACEHOLDER = "<placeholder>"  # «путь» глифа-заглушки
+PLACEHOLDER_MM = (2.0, 3.0)    # ширина и высота рамки
+
+# =====================================================
+# СЛУЧАЙНОСТЬ
+# =====================================================
+
+def new_seed():
+    return random.SystemRandom().randrange(2 ** 32)
+
+def derive_rng(seed, *keys):
+    """Независимый поток случайных чисел для (seed, страница, строка, ...).
+
+    Строковый seed хешируется детерминированно, поэтому поток не зависит
+    ни от PYTHONHASHSEED, ни от порядка рендера страниц.
+    """
+    return random.Random(":".join(str(k) for k in (seed,) + keys))
+
 # =====================================================
 # ЕДИНИЦЫ
 # =====================================================
 
-def cm_to_px(cm):
-    return int(cm * DPI / 2.54)
+def cm_to_px(cm, dpi=DPI):
+    return int(cm * dpi / 2.54)
 
-def mm_to_px(mm):
-    return int(mm * DPI / 25.4)
+def mm_to_px(mm, dpi=DPI):
+    return int(mm * dpi / 25.4)
 
 PAGE_W = cm_to_px(A4_WIDTH_CM)
 PAGE_H = cm_to_px(A4_HEIGHT_CM)
@@ -58,6 +135,23 @@ LINE_WIDTH_PX = mm_to_px(LINE_THICKNESS_MM)
 
 MAX_LINES_PER_PAGE = (PAGE_H - 2 * MARGIN_PX) // LINE_SPACING_PX
 
+@lru_cache(maxsize=None)
+def page_geometry(dpi=DPI):
+    """Размеры страницы в пикселях для заданного DPI.
+
+    factor — во сколько раз пиксель при этом DPI крупнее/мельче, чем
+    при DPI; на него умножаются все пиксельные величины стиля.
+    """
+    return {
+        "dpi": dpi,
+        "factor": dpi / DPI,
+        "w": cm_to_px(A4_WIDTH_CM, dpi),
+        "h": cm_to_px(A4_HEIGHT_CM, dpi),
+        "margin": cm_to_px(MARGIN_CM, dpi),
+        "line_spacing": cm_to_px(LINE_SPACING_CM, dpi),
+        "line_width": max(1, mm_to_px(LINE_THICKNESS_MM, dpi)),
+    }
+
 # =====================================================
 # ДИАПАЗОНЫ
 # =====================================================
@@ -79,46 +173,360 @@ def parse_float_range(value):
 # ФАЙЛЫ СТРАНИЦ
 # =====================================================
 
-def ensure_output_dir():
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
+def ensure_output_dir(output_dir=OUTPUT_DIR):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
-def get_next_page_number():
-    ensure_output_dir()
+def get_next_page_number(output_dir=OUTPUT_DIR):
+    ensure_output_dir(output_dir)
     existing = []
-    for f in os.listdir(OUTPUT_DIR):
-        match = re.match(r"page_(\d+)\.png", f)
+    for f in os.listdir(output_dir):
+        match = re.match(r"(?:letters|full)-page_(\d+)\.(?:png|tif)$", f)
         if match:
             existing.append(int(match.group(1)))
     return max(existing, default=0) + 1
 
-def save_page(letters_layer, page_number):
-    letters_path = os.path.join(OUTPUT_DIR, f"letters-page_{page_number}.png")
-    bg_path = os.path.join(OUTPUT_DIR, f"full-page_{page_number}.png")
+def colorize_letters(luma, ink_color):
+    """Яркость слоя букв → RGB: чёрное становится цветом чернил, белое
+    остаётся белым."""
+    if tuple(ink_color) == (0, 0, 0):
+        return luma.convert("RGB")
+    return ImageOps.colorize(luma, black=tuple(ink_color), white=(255, 255, 255))
+
+def to_letters_mode(luma, alpha, mode, ink_color):
+    if mode == "LA":
+        return Image.merge("LA", (luma, alpha))
+    if mode in ("RGBA", "P"):
+        rgba = colorize_letters(luma, ink_color)
+        rgba.putalpha(alpha)
+        if mode == "RGBA":
+            return rgba
+        return rgba.quantize(method=Image.Quantize.FASTOCTREE)
+    # 1 бит: чернила там, где буква непрозрачна
+    return alpha.point(
+        lambda a: 0 if a >= 128 else 255, "1"
+    )
 
-    letters_layer.save(letters_path, dpi=(DPI, DPI))
+def encode_image(img, path, output, dpi=DPI):
+    params = {"dpi": (dpi, dpi)}
+    if output["format"] == "png":
+        params["compress_level"] = output["compress_level"]
+        params["compress_type"] = PNG_STRATEGIES[output["png_strategy"]]
+    elif output["tiff_compression"] != "none":
+        params["compression"] = output["tiff_compression"]
+    img.save(path, **params)
+
+def to_gray(color):
+    r, g, b = color
+    return (r * 299 + g * 587 + b * 114) // 1000
+
+def draw_background(mode, dpi=DPI):
+    geom = page_geometry(dpi)
+    w, h, margin = geom["w"], geom["h"], geom["margin"]
+
+    if mode == "RGB":
+        bg = Image.new("RGB", (w, h), BACKGROUND_COLOR)
+        line_color = LINE_COLOR
+    else:
+        bg = Image.new("L", (w, h), to_gray(BACKGROUND_COLOR))
+        line_color = to_gray(LINE_COLOR)
 
-    bg = Image.new("RGB", (PAGE_W, PAGE_H), BACKGROUND_COLOR)
     draw = ImageDraw.Draw(bg)
 
-    y = MARGIN_PX
-    while y < PAGE_H - MARGIN_PX:
+    y = margin
+    while y < h - margin:
         draw.line(
-            [(MARGIN_PX, y), (PAGE_W - MARGIN_PX, y)],
-            fill=LINE_COLOR,
-            width=LINE_WIDTH_PX
+            [(margin, y), (w - margin, y)],
+            fill=line_color,
+            width=geom["line_width"]
+        )
+        y += geom["line_spacing"]
+
+    return bg
+
+def save_page(letters_layer, page_number, output_dir=OUTPUT_DIR, output=None,
+              ink_color=(0, 0, 0), dpi=DPI):
+    luma, alpha = letters_layer.split()
+    return write_page(luma, alpha, page_number, output_dir, output, ink_color, dpi)
+
+def write_page(luma, alpha, page_number, output_dir=OUTPUT_DIR, output=None,
+               ink_color=(0, 0, 0), dpi=DPI):
+    """Слой букв, заданный каналами яркости и прозрачности, → файлы
+    letters-page и full-page. Каналы только читаются."""
+    output = output or DEFAULT_OUTPUT
+    ext = OUTPUT_EXT[output["format"]]
+
+    letters_path = os.path.join(output_dir, f"letters-page_{page_number}{ext}")
+    bg_path = os.path.join(output_dir, f"full-page_{page_number}{ext}")
+
+    if output["letters_layer"]:
+        encode_image(
+            to_letters_mode(luma, alpha, output["letters_mode"], ink_color),
+            letters_path, output, dpi
         )
-        y += LINE_SPACING_PX
+    else:
+        letters_path = None
 
-    bg.paste(letters_layer, (0, 0), letters_layer)
-    bg.save(bg_path, dpi=(DPI, DPI))
+    bg = draw_background(output["page_mode"], dpi)
+    ink = colorize_letters(luma, ink_color) if bg.mode == "RGB" else luma
+    bg.paste(ink, (0, 0), alpha)
+
+    if output["page_mode"] == "1":
+        bg = bg.point(lambda v: 255 if v >= 128 else 0, "1")
+
+    encode_image(bg, bg_path, output, dpi)
 
     print(f"Сохранена страница {page_number}")
 
+    return letters_path, bg_path
+
+class PageWriter:
+    """Фоновая запись страниц: фон, наложение букв и кодирование идут
+    в отдельном потоке, пока рендер собирает следующую страницу.
+
+    Очередь ограничена depth страницами, поэтому в памяти одновременно
+    не больше depth + 2 слоёв букв: собираемый, записываемый и ожидающие.
+    Ошибка записи пробрасывается из следующего submit() или из close().
+    """
+
+    def __init__(self, depth=PAGE_WRITE_QUEUE):
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.results = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            # после ошибки очередь только разгружается, чтобы submit не завис
+            if self.error is None:
+                try:
+                    self.results.append(save_page(*job))
+                except Exception as e:
+                    self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def new_layer(self, dpi=DPI):
+        """Слой для render_page; None — render_page заводит его сам."""
+        return None
+
+    def submit(self, *args):
+        """Аргументы как у save_page. Блокирует, если очередь полна."""
+        self._check()
+        self.queue.put(args)
+
+    def close(self):
+        """Дожидается записи всех страниц; возвращает их пути по порядку."""
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.queue.put(None)
+            self.thread.join()
+
+# =====================================================
+# ОБЩАЯ ПАМЯТЬ
+# =====================================================
+# Слой букв на 1200 DPI весит ~280 МБ; передавать его процессам через
+# pickle — это копия в каждом процессе и секунды на сериализацию. Вместо
+# этого страница сразу рисуется в multiprocessing.shared_memory двумя
+# плоскостями (яркость, прозрачность), а процессу передаётся только
+# описатель. Плоскостей две, потому что Pillow отображает на чужой буфер
+# только одноканальные изображения, а не LA.
+
+def shared_planes(shm, size):
+    """Плоскости слоя как L-изображения поверх общей памяти (без копии)."""
+    w, h = size
+    n = w * h
+    return [
+        Image.frombuffer("L", size, shm.buf[i * n:(i + 1) * n], "raw", "L", 0, 1)
+        for i in (0, 1)
+    ]
+
+def shared_layer(size):
+    """Пустой слой букв в общей памяти: (shm, [яркость, прозрачность])."""
+    w, h = size
+    shm = shared_memory.SharedMemory(create=True, size=2 * w * h)
+    planes = shared_planes(shm, size)
+    for plane in planes:
+        # frombuffer отдаёт изображение только для чтения, и первая же
+        # запись скопировала бы его в обычную память; буфер свой и
+        # новый (заполнен нулями), так что рисуем прямо в него
+        plane.readonly = 0
+    return shm, planes
+
+def free_shared(shm):
+    """Удаляет общую память. Если на буфер ещё ссылаются изображения,
+    отображение закроется вместе с ними."""
+    shm.unlink()
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+def save_shared_page(layer, page_number, output_dir=OUTPUT_DIR, output=None,
+                     ink_color=(0, 0, 0), dpi=DPI):
+    """save_page для слоя в общей памяти: читает буфер на месте и
+    отсоединяется от него. Выполняется в процессе-кодировщике."""
+    shm = shared_memory.SharedMemory(name=layer["name"])
+    luma = alpha = None
+    try:
+        luma, alpha = shared_planes(shm, layer["size"])
+        return write_page(luma, alpha, page_number, output_dir, output,
+                          ink_color, dpi)
+    except Exception as e:
+        # кадры traceback держат изображения поверх буфера
+        traceback.clear_frames(e.__traceback__)
+        raise
+    finally:
+        # пока живы изображения, close() не пройдёт
+        luma = alpha = None
+        shm.close()
+
+class SharedPageWriter:
+    """То же, что PageWriter, но страницы кодируются в processes
+    процессах. Страница рисуется прямо в общую память (new_layer), в
+    процесс уходит только описатель; не больше depth страниц ждут
+    записи одновременно, их общая память освобождается сразу после
+    записи.
+    """
+
+    def __init__(self, depth=PAGE_WRITE_QUEUE, processes=PAGE_WRITE_PROCESSES):
+        self.depth = max(1, depth)
+        self.pool = ProcessPoolExecutor(max_workers=processes)
+        self.pending = deque()   # (future, shm) в порядке страниц
+        self.current = None      # shm слоя, который сейчас рисуется
+        self.results = []
+
+    def _finish_oldest(self):
+        future, shm = self.pending.popleft()
+        try:
+            self.results.append(future.result())
+        finally:
+            free_shared(shm)
+
+    def new_layer(self, dpi=DPI):
+        """Плоскости [яркость, прозрачность] следующей страницы в общей
+        памяти. Их заполняет render_page и сразу отдаёт в submit — ссылок
+        на них держать нельзя, иначе память не отсоединить. Блокирует,
+        пока слишком много страниц ждёт записи."""
+        while len(self.pending) >= self.depth:
+            self._finish_oldest()
+
+        geom = page_geometry(dpi)
+        self.current, planes = shared_layer((geom["w"], geom["h"]))
+        return planes
+
+    def submit(self, planes, *args):
+        """planes — из new_layer, остальные аргументы как у save_page."""
+        shm, self.current = self.current, None
+        layer = {"name": shm.name, "size": planes[0].size}
+        del planes
+        try:
+            future = self.pool.submit(save_shared_page, layer, *args)
+        except Exception:
+            free_shared(shm)
+            raise
+        self.pending.append((future, shm))
+
+    def close(self):
+        """Дожидается записи всех страниц; возвращает их пути по порядку."""
+        try:
+            while self.pending:
+                self._finish_oldest()
+        finally:
+            self._release()
+        return self.results
+
+    def _release(self):
+        # после ошибки оставшиеся страницы дописываются, а память
+        # освобождается в любом случае
+        if self.current is not None:
+            free_shared(self.current)
+            self.current = None
+        while self.pending:
+            future, shm = self.pending.popleft()
+            try:
+                future.result()
+            except Exception:
+                pass
+            free_shared(shm)
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # кадры traceback держат плоскости недорисованной страницы
+            traceback.clear_frames(tb)
+            self._release()
+
 # =====================================================
 # СТИЛЬ
 # =====================================================
 
+def parse_output(cfg):
+    output = dict(DEFAULT_OUTPUT)
+    output.update(cfg)
+
+    if output["format"] not in OUTPUT_EXT:
+        raise ValueError(f"Неизвестный формат вывода: {output['format']}")
+    if output["png_strategy"] not in PNG_STRATEGIES:
+        raise ValueError(f"Неизвестная стратегия PNG: {output['png_strategy']}")
+    if output["tiff_compression"] not in TIFF_COMPRESSIONS:
+        raise ValueError(f"Неизвестное сжатие TIFF: {output['tiff_compression']}")
+    if output["letters_mode"] not in LETTERS_MODES:
+        raise ValueError(f"Неизвестный режим слоя букв: {output['letters_mode']}")
+    if output["page_mode"] not in PAGE_MODES:
+        raise ValueError(f"Неизвестный режим страницы: {output['page_mode']}")
+
+    # G4 бывает только однобитным
+    if output["format"] == "tiff" and output["tiff_compression"] == "group4":
+        output["letters_mode"] = "1"
+        output["page_mode"] = "1"
+
+    return output
+
+def parse_missing(cfg):
+    if cfg is None:
+        cfg = {}
+    if not isinstance(cfg, dict):
+        raise ValueError(
+            f"missing_glyph должен быть словарём {{mode, substitutes}}, а не {cfg!r}"
+        )
+
+    mode = cfg.get("mode", "substitute")
+    if mode not in MISSING_MODES:
+        raise ValueError(f"missing_glyph.mode: {mode!r}, ожидается одно из {MISSING_MODES}")
+
+    substitutes = cfg.get("substitutes") or {}
+    if not isinstance(substitutes, dict) or not all(
+        isinstance(k, str) and isinstance(v, str) for k, v in substitutes.items()
+    ):
+        raise ValueError("missing_glyph.substitutes: ожидается словарь {символ: замена}")
+
+    return {
+        "mode": mode,
+        "substitutes": {**SUBSTITUTES, **substitutes},
+    }
+
 def load_style(path):
     with open(path, "r", encoding="utf-8") as f:
         cfg = yaml.safe_load(f)
@@ -148,6 +556,14 @@ def load_style(path):
         sorted(mm_to_px(x) for x in punct["anchor_jitter_mm"])
     )
 
+    style["missing_glyph"] = parse_missing(cfg.get("missing_glyph", {}))
+
+    style["cursive"] = bool(cfg.get("cursive", False))
+    style["join_stroke_px"] = mm_to_px(cfg.get("join_stroke_mm", 0.4))
+    style["seed"] = cfg.get("seed")
+    style["ink_color"] = tuple(cfg.get("ink_color", (0, 0, 0)))
+    style["output"] = parse_output(cfg.get("output", {}))
+
     overlaps_px = {}
     for ch, data in cfg.get("overlaps", {}).items():
         v = data.get("right_mm", 0)
@@ -169,133 +585,550 @@ def scan_fonts(cat):
     base = os.path.join(LETTERS_DIR, cat)
     if not os.path.exists(base):
         return []
-    return [os.path.join(base, d) for d in os.listdir(base)]
+    # порядок фиксирован, чтобы один seed давал один результат на любой ФС
+    return [os.path.join(base, d) for d in sorted(os.listdir(base))]
 
 RUS = scan_fonts("russian")
 ENG = scan_fonts("english")
 SYM = scan_fonts("symbols")
+FONTS = {"russian": RUS, "english": ENG, "symbols": SYM}
 
 def is_russian(c):
     return c.lower() in "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
 
-def load_letter(ch):
-    if ch == " ":
-        return None
+GLYPH_FILE_RE = re.compile(r"^(.+?)(?:_(\d{2}))?\.png$")
+
+@lru_cache(maxsize=None)
+def font_index(font_dir):
+    """Имя символа → [(ключ глифа, файл), ...] в порядке вариантов.
+
+    Номерные файлы после extract_letters (_0001.png) разрешаются через
+    manifest.json (его пишет rename.py), уже переименованные — по имени
+    файла. Номерной файл без записи в манифесте глифом не считается.
+    """
+    index = {}
+    indexed = set()
+
+    manifest_path = os.path.join(font_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        for entry in manifest["glyphs"].values():
+            index.setdefault(entry["name"], []).append(
+                (entry["variant"], entry["glyph"], entry["file"])
+            )
+            indexed.add(entry["file"])
+
+    for f in os.listdir(font_dir):
+        m = GLYPH_FILE_RE.match(f)
+        if not m or f in indexed or f.startswith("_"):
+            continue
+        variant = int(m.group(2)) if m.group(2) else 1
+        index.setdefault(m.group(1), []).append((variant, f[:-len(".png")], f))
+
+    return {
+        name: [(key, f) for _, key, f in sorted(entries)]
+        for name, entries in index.items()
+    }
+
+def list_glyphs(font_dir):
+    """Все глифы папки шрифта: [(ключ глифа, путь), ...], по ключу."""
+    return sorted(
+        (key, os.path.join(font_dir, f))
+        for entries in font_index(font_dir).values()
+        for key, f in entries
+    )
 
+@lru_cache(maxsize=None)
+def open_glyph(path):
+    """Декодирует глиф один раз; дальше изображение берётся из кэша.
+
+    Глифы хранятся как LA (яркость + альфа): три канала RGB у скана
+    всё равно одинаковые, а цвет чернил добавляется при сохранении.
+    Возвращаемое изображение общее — его нельзя менять на месте.
+    """
+    if path == PLACEHOLDER:
+        w, h = (mm_to_px(v) for v in PLACEHOLDER_MM)
+        img = Image.new("LA", (w, h), (0, 0))
+        ImageDraw.Draw(img).rectangle(
+            (0, 0, w - 1, h - 1), outline=(0, 255), width=max(1, mm_to_px(0.3))
+        )
+        return img
+    return Image.open(path).convert("LA")
+
+def warm_glyphs():
+    """Заранее декодирует все глифы и строит таблицы соединений
+    (для долгоживущего процесса)."""
+    compile_glyph_table()
+    count = 0
+    for font in RUS + ENG + SYM:
+        join_table(font)
+        for f in os.listdir(font):
+            if f.lower().endswith(".png"):
+                open_glyph(os.path.join(font, f))
+                count += 1
+    return count
+
+@lru_cache(maxsize=None)
+def glyph_mip(path, level):
+    """Уровень mip-пирамиды глифа: level 0 — оригинал, каждый следующий
+    вдвое меньше. Уровни считаются один раз и остаются в кэше."""
+    if level == 0:
+        return open_glyph(path)
+    return glyph_mip(path, level - 1).reduce(2)
+
+def mip_level(dpi):
+    """Самый мелкий уровень пирамиды, который ещё не мельче нужного DPI."""
+    level = 0
+    while DPI / 2 ** (level + 1) >= dpi:
+        level += 1
+    return level
+
+@lru_cache(maxsize=None)
+def join_table(font_dir):
+    """Таблица соединений шрифта по anchors.json.
+
+    dx[a, b] — сдвиг левого края глифа b относительно глифа a (в пикселях
+    оригинала), при котором вход b встаёт под выход a; entry / exit —
+    сами якоря для соединительного штриха. Считается один раз на шрифт,
+    при рендере — один поиск на пару букв. Кандидаты auto_anchors.py
+    ("auto": true), которые ещё не приняты в AnchorEditor, не берутся.
+    """
+    path = os.path.join(font_dir, ANCHORS_NAME)
+    anchors = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            anchors = json.load(f)
+
+    keys = sorted(
+        k for k, v in anchors.items()
+        if "entry" in v and "exit" in v and not v.get("auto")
+    )
+    entry = np.array([anchors[k]["entry"] for k in keys], np.float32).reshape(-1, 2)
+    exit_ = np.array([anchors[k]["exit"] for k in keys], np.float32).reshape(-1, 2)
+
+    return {
+        "index": {k: i for i, k in enumerate(keys)},
+        "dx": exit_[:, None, 0] - entry[None, :, 0],
+        "entry": entry,
+        "exit": exit_,
+    }
+
+def glyph_name(ch):
+    """(категория, имя глифа) для символа."""
     if ch.isalpha():
-        fonts = RUS if is_russian(ch) else ENG
-        name = ch if ch.isupper() else f"{ch}l"
-    else:
-        fonts = SYM
-        name = SYMBOL_NAME_MAP.get(ch, ch)
+        category = "russian" if is_russian(ch) else "english"
+        return category, (ch if ch.isupper() else f"{ch}l")
+    return "symbols", SYMBOL_NAME_MAP.get(ch, ch)
+
+def alias_table(weights):
+    """Таблицы метода псевдонимов (Vose): выбор с весами за O(1)."""
+    n = len(weights)
+    total = sum(weights)
+    scaled = [w * n / total for w in weights]
+    prob = [1.0] * n
+    alias = list(range(n))
+
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1.0 - scaled[s]
+        (small if scaled[l] < 1.0 else large).append(l)
+
+    return prob, alias
+
+@lru_cache(maxsize=None)
+def variant_table(category, name):
+    """Все варианты глифа во всех шрифтах категории одним плоским списком.
+
+    Каждый шрифт весит одинаково, его варианты (_02, _03, …) делят вес
+    поровну. Возвращает (пути, prob, alias) или None, если глифа нет.
+    """
+    paths, weights = [], []
+    for font in FONTS[category]:
+        entries = font_index(font).get(name, [])
+        for _, file in entries:
+            paths.append(os.path.join(font, file))
+            weights.append(1.0 / len(entries))
+
+    if not paths:
+        return None
+    return (paths,) + alias_table(weights)
+
+MISSING = None   # в таблице символов: глифа нет ни в одном шрифте
+
+@lru_cache(maxsize=1)
+def compile_glyph_table():
+    """Символ → таблица вариантов (variant_table) или MISSING.
+
+    Заранее заполняется для всех известных символов: алфавиты, цифры,
+    символы из SYMBOL_NAME_MAP и имена глифов из папок символов.
+    Незнакомые символы дописываются при первой встрече, так что
+    отсутствующий глиф стоит один поиск в словаре на каждое вхождение.
+    """
+    chars = set("абвгдеёжзийклмнопрстуфхцчшщъыьэюя")
+    chars |= {c.upper() for c in chars}
+    chars |= set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+    chars |= set("0123456789") | set(SYMBOL_NAME_MAP) | set(SUBSTITUTES.values())
+    for font in SYM:
+        chars |= {name for name in font_index(font) if len(name) == 1}
+
+    table = {ch: variant_table(*glyph_name(ch)) for ch in chars}
+    table[" "] = MISSING
+    table[PLACEHOLDER_CHAR] = ([PLACEHOLDER], [1.0], [0])
+    return table
+
+def glyph_table(ch):
+    table = compile_glyph_table()
+    if ch not in table:
+        table[ch] = variant_table(*glyph_name(ch))
+    return table[ch]
+
+def missing_glyphs(text):
+    """Символы текста без глифа: Counter {символ: сколько раз}."""
+    return Counter(
+        ch for ch in text
+        if not ch.isspace() and glyph_table(ch) is MISSING
+    )
+
+def apply_fallback(text, missing):
+    """Заменяет символы без глифа по правилам стиля (missing_glyph)."""
+    out = []
+    for ch in text:
+        if ch.isspace() or glyph_table(ch) is not MISSING:
+            out.append(ch)
+            continue
 
-    for f in random.sample(fonts, len(fonts)):
-        p = os.path.join(f, f"{name}.png")
-        if os.path.exists(p):
-            return Image.open(p).convert("RGBA")
+        mode = missing["mode"]
+        if mode == "substitute":
+            sub = missing["substitutes"].get(ch)
+            if sub is not None and all(glyph_table(c) is not MISSING for c in sub):
+                out.append(sub)
+        elif mode == "box":
+            out.append(PLACEHOLDER_CHAR)
+        # skip — символ просто выпадает
+
+    return "".join(out)
+
+def missing_report(text, missing):
+    """Текст отчёта об отсутствующих глифах или пустая строка."""
+    counts = missing_glyphs(text)
+    if not counts:
+        return ""
+
+    parts = []
+    for ch, n in counts.most_common():
+        if missing["mode"] == "box":
+            action = "рамка"
+        else:
+            sub = missing["substitutes"].get(ch) if missing["mode"] == "substitute" else None
+            ok = sub is not None and all(glyph_table(c) is not MISSING for c in sub)
+            action = f"→ {sub}" if ok else "пропущен"
+        parts.append(f"{ch!r} ×{n} ({action})")
 
-    return None
+    return "Нет глифов: " + ", ".join(parts)
+
+def resolve_letter(ch, rng):
+    table = glyph_table(ch)
+    if table is MISSING:
+        return None
+
+    paths, prob, alias = table
+    i = rng.randrange(len(paths))
+    return paths[i] if rng.random() < prob[i] else paths[alias[i]]
 
 # =====================================================
-# ИЗМЕРЕНИЕ СЛОВА
+# РАЗМЕТКА
 # =====================================================
+# Разметка сразу решает всё случайное: шрифт, вариант, масштаб, поворот
+# и положение каждой буквы в пикселях полного разрешения. Рендер только
+# повторяет записанное, поэтому ширина строки при переносе та же, что и
+# на странице.
+
+def rotated_size(w, h, angle):
+    """Рамка глифа w×h после поворота на angle градусов (как expand=True)."""
+    a = math.radians(angle)
+    c, s = abs(math.cos(a)), abs(math.sin(a))
+    return math.ceil(w * c + h * s), math.ceil(w * s + h * c)
+
+def baseline_for(line, style, rng, geom):
+    f = geom["factor"]
+    return (
+        geom["margin"]
+        + line * geom["line_spacing"]
+        + int(round(rng.randint(*style["baseline_jitter_px"]) * f))
+        + int(round(rng.randint(*style["line_spacing_jitter_px"]) * f))
+    )
 
-def measure_word(word, style):
-    width = 0
+def glyph_top(ch, h, baseline_y, style, rng, f):
+    """Верх глифа: хвостатые буквы и пунктуация висят на своих якорях."""
+    def px(v):
+        return int(round(v * f))
+
+    if ch in style["desc_letters"]:
+        return baseline_y - px(style["desc_anchor_px"]) + px(rng.randint(
+            *style["desc_anchor_jitter_px"]
+        ))
+    if ch in style["punct_letters"]:
+        return baseline_y - px(style["punct_anchor_px"]) + px(rng.randint(
+            *style["punct_anchor_jitter_px"]
+        ))
+    return baseline_y - h
+
+def word_font(word, rng):
+    """Шрифт для слитного слова: только те, где есть все его буквы."""
+    letters = [ch for ch in word if ch.isalpha()]
+    if not letters:
+        return None
+
+    category, _ = glyph_name(letters[0])
+    names = [glyph_name(ch)[1] for ch in letters]
+    eligible = [f for f in FONTS[category]
+                if all(n in font_index(f) for n in names)]
+    return rng.choice(eligible) if eligible else None
+
+def place_cursive_word(word, font, line, cx, style, rng, geom):
+    """Раскладка слова одним шрифтом и одним масштабом. Соседние буквы
+    ставятся по таблице соединений (вход следующей под выходом
+    предыдущей плюс кернинг) и связываются штрихом; без якорей — обычный
+    кернинг. Поворот букв здесь не применяется, чтобы не рвать соединения.
+
+    Ничего не рисует: возвращает (глифы, штрихи, x после слова) в формате
+    layout_pages."""
+    f = geom["factor"]
+    table = join_table(font)
+    index = font_index(font)
+    scale = (1 + rng.uniform(*style["scale_jitter"])) * f
+    baseline_y = baseline_for(line, style, rng, geom)
+
+    glyphs, strokes = [], []
+    prev = None   # (x, y, ширина, индекс в таблице)
     for ch in word:
-        img = load_letter(ch)
-        if not img:
-            continue
+        entries = index.get(glyph_name(ch)[1])
+        if entries:
+            key, file = entries[rng.randrange(len(entries))]
+            path = os.path.join(font, file)
+        else:
+            key, path = None, resolve_letter(ch, rng)
+            if not path:
+                continue
 
-        scale = 1 + random.uniform(*style["scale_jitter"])
-        w = int(img.width * scale)
+        full = open_glyph(path)
+        w = max(1, int(full.width * scale))
+        h = max(1, int(full.height * scale))
+        b = table["index"].get(key)
+        kerning = int(round(rng.randint(*style["kerning_px"]) * f))
+        y = glyph_top(ch, h, baseline_y, style, rng, f)
+
+        joined = prev is not None and prev[3] is not None and b is not None
+        if joined:
+            x = prev[0] + int(round(table["dx"][prev[3], b] * scale)) + kerning
+        elif prev is None:
+            x = cx
+        else:
+            x = prev[0] + prev[2] + kerning
 
-        overlap = random.randint(*style["overlap_right_px"].get(ch, (0, 0)))
-        kerning = random.randint(*style["kerning_px"])
+        glyphs.append((path, x, y, w, h, 0.0))
 
-        width += w - overlap + kerning
+        if joined:
+            ex, ey = table["exit"][prev[3]] * scale
+            nx, ny = table["entry"][b] * scale
+            strokes.append((prev[0] + ex, prev[1] + ey, x + nx, y + ny))
 
-    return width
+        prev = (x, y, w, b)
 
-# =====================================================
-# РЕНДЕР
-# =====================================================
+    if prev is None:
+        return glyphs, strokes, cx
+    end = prev[0] + prev[2] + int(round(rng.randint(*style["kerning_px"]) * f))
+    return glyphs, strokes, end
 
-def render(text, style):
-    ensure_output_dir()
-    page_number = get_next_page_number()
+def place_letters(word, line, cx, style, rng, geom):
+    """Раскладка обычного слова по буквам: (глифы, x после слова)."""
+    glyphs = []
+    for ch in word:
+        path = resolve_letter(ch, rng)
+        if not path:
+            continue
 
-    letters_layer = Image.new("RGBA", (PAGE_W, PAGE_H), (0, 0, 0, 0))
+        full = open_glyph(path)
+        scale = 1 + rng.uniform(*style["scale_jitter"])
+        w = max(1, int(full.width * scale))
+        h = max(1, int(full.height * scale))
+        angle = rng.uniform(*style["rotation_deg"])
+        box_w, box_h = rotated_size(w, h, angle)
 
-    cx = MARGIN_PX
-    line = 0
+        overlap = rng.randint(*style["overlap_right_px"].get(ch, (0, 0)))
+        kerning = rng.randint(*style["kerning_px"])
+
+        baseline_y = baseline_for(line, style, rng, geom)
+        y = glyph_top(ch, box_h, baseline_y, style, rng, 1)
+
+        glyphs.append((path, cx, y, w, h, angle))
+        cx += box_w - overlap + kerning
+
+    return glyphs, cx
 
-    tokens = re.findall(r"\n| +|[^\s]+", text)
+def place_word(word, line, cx, style, rng):
+    """(глифы, штрихи, x после слова) для слова, начатого в cx."""
+    geom = page_geometry(DPI)
+    if style.get("cursive"):
+        font = word_font(word, rng)
+        if font is not None:
+            return place_cursive_word(word, font, line, cx, style, rng, geom)
 
-    for token in tokens:
+    glyphs, end = place_letters(word, line, cx, style, rng, geom)
+    return glyphs, [], end
 
+def ink_right(glyphs, default):
+    """Правый край чернил разложенных глифов."""
+    return max(
+        (x + rotated_size(w, h, angle)[0] for _, x, _, w, h, angle in glyphs),
+        default=default
+    )
+
+def layout_pages(text, style, seed):
+    """Разбивает текст на страницы и строки и раскладывает буквы:
+    pages[page][line] = {"glyphs": [...], "strokes": [...]}, глиф —
+    (путь, x, y, ширина, высота, угол), штрих — (x0, y0, x1, y1), всё в
+    пикселях полного разрешения.
+
+    Случайные величины строки берутся из потока (seed, страница, строка),
+    так что разметка целиком определяется seed, а каждую страницу потом
+    можно отрисовать отдельно, в любом порядке и на любом воркере.
+    """
+    text = apply_fallback(text, style["missing_glyph"])
+
+    pages = []
+    lines = None
+    rng = None
+    cx = MARGIN_PX
+
+    def new_line():
+        nonlocal lines, rng, cx
+        if lines is None or len(lines) == MAX_LINES_PER_PAGE:
+            lines = []
+            pages.append(lines)
+        lines.append({"glyphs": [], "strokes": []})
+        rng = derive_rng(seed, len(pages) - 1, len(lines) - 1)
+        cx = MARGIN_PX
+
+    new_line()
+    for token in re.findall(r"\n| +|[^\s]+", text):
         if token == "\n":
-            line += 1
-            cx = MARGIN_PX
-        elif token.isspace():
-            cx += random.randint(*style["space_px"])
+            new_line()
+            continue
+        if token.isspace():
+            cx += rng.randint(*style["space_px"])
             continue
-        else:
-            if cx + measure_word(token, style) > PAGE_W - MARGIN_PX:
-                line += 1
-                cx = MARGIN_PX
-
-        if line >= MAX_LINES_PER_PAGE:
-            save_page(letters_layer, page_number)
-            page_number += 1
-            letters_layer = Image.new("RGBA", (PAGE_W, PAGE_H), (0, 0, 0, 0))
-            line = 0
-            cx = MARGIN_PX
-
-        for ch in token:
-            img = load_letter(ch)
-            if not img:
-                continue
 
-            scale = 1 + random.uniform(*style["scale_jitter"])
-            img = img.resize(
-                (int(img.width * scale), int(img.height * scale)),
-                Image.BICUBIC
-            )
+        glyphs, strokes, end = place_word(token, len(lines) - 1, cx, style, rng)
 
-            img = img.rotate(
-                random.uniform(*style["rotation_deg"]),
-                expand=True,
-                resample=Image.BICUBIC
-            )
+        # не влезло — слово переносится и раскладывается заново
+        # из потока новой строки
+        if ink_right(glyphs, end) > PAGE_W - MARGIN_PX and lines[-1]["glyphs"]:
+            new_line()
+            glyphs, strokes, end = place_word(token, len(lines) - 1, cx,
+                                              style, rng)
 
-            w, h = img.size
-            overlap = random.randint(*style["overlap_right_px"].get(ch, (0, 0)))
-            kerning = random.randint(*style["kerning_px"])
-            advance = w - overlap + kerning
+        lines[-1]["glyphs"].extend(glyphs)
+        lines[-1]["strokes"].extend(strokes)
+        cx = end
+
+    return pages
+
+# =====================================================
+# РЕНДЕР
+# =====================================================
 
-            baseline_y = (
-                MARGIN_PX
-                + line * LINE_SPACING_PX
-                + random.randint(*style["baseline_jitter_px"])
-                + random.randint(*style["line_spacing_jitter_px"])
+def render_page(lines, style, dpi=DPI, planes=None):
+    """Рисует одну разложенную страницу (см. layout_pages). При dpi < DPI
+    получается предпросмотр: раскладка та же, что и при полном рендере,
+    меняется только масштаб, а глифы берутся с подходящего уровня
+    mip-пирамиды.
+
+    Возвращает LA-слой букв. Если переданы planes — пустые L-плоскости
+    [яркость, прозрачность] (например, из SharedPageWriter.new_layer), —
+    страница рисуется в них и возвращаются они же.
+    """
+    geom = page_geometry(dpi)
+    f = geom["factor"]
+    level = mip_level(dpi)
+
+    if planes is None:
+        letters_layer = Image.new("LA", (geom["w"], geom["h"]), (0, 0))
+        draws = [(ImageDraw.Draw(letters_layer), (JOIN_INK, 255))]
+
+        def paste(img, pos):
+            letters_layer.paste(img, pos, img)
+    else:
+        letters_layer = planes
+        luma, alpha = planes
+        draws = [(ImageDraw.Draw(luma), JOIN_INK), (ImageDraw.Draw(alpha), 255)]
+
+        # наложение по маске идёт поканально, так что по плоскостям
+        # результат тот же, что и на LA-слое
+        def paste(img, pos):
+            mask = img.getchannel("A")
+            luma.paste(img.getchannel("L"), pos, mask)
+            alpha.paste(mask, pos, mask)
+
+    stroke = max(1, int(round(style["join_stroke_px"] * f)))
+
+    for line in lines:
+        # соединительные штрихи — под буквами
+        for x0, y0, x1, y1 in line["strokes"]:
+            for draw, fill in draws:
+                draw.line((x0 * f, y0 * f, x1 * f, y1 * f),
+                          fill=fill, width=stroke)
+
+        for path, x, y, w, h, angle in line["glyphs"]:
+            img = glyph_mip(path, level).resize(
+                (max(1, round(w * f)), max(1, round(h * f))), Image.BICUBIC
+            )
+            if angle:
+                img = img.rotate(angle, expand=True, resample=Image.BICUBIC)
+
+            # глиф ставится по центру своей рамки из разметки: размеры
+            # уменьшенного и повёрнутого глифа округляются по-своему, а
+            # центр от масштаба не зависит, так что ошибка не копится
+            box_w, box_h = rotated_size(w, h, angle)
+            pos = (round((x + box_w / 2) * f - img.width / 2),
+                   round((y + box_h / 2) * f - img.height / 2))
+            paste(img, pos)
+
+    return letters_layer
+
+def render(text, style, seed=None, dpi=DPI, output_dir=OUTPUT_DIR):
+    if seed is None:
+        seed = style.get("seed")
+    if seed is None:
+        seed = new_seed()
+    print(f"Seed: {seed}")
+
+    report = missing_report(text, style["missing_glyph"])
+    if report:
+        print(report)
+
+    ensure_output_dir(output_dir)
+    page_number = get_next_page_number(output_dir)
+
+    if PAGE_WRITE_PROCESSES > 0:
+        writer = SharedPageWriter(processes=PAGE_WRITE_PROCESSES)
+    else:
+        writer = PageWriter()
+
+    with writer:
+        for page_index, lines in enumerate(layout_pages(text, style, seed)):
+            # слой не держится в переменной: после submit он у писателя
+            writer.submit(
+                render_page(lines, style, dpi, writer.new_layer(dpi)),
+                page_number + page_index, output_dir,
+                style["output"], style["ink_color"], dpi
             )
 
-            if ch in style["desc_letters"]:
-                py = baseline_y - style["desc_anchor_px"] + random.randint(
-                    *style["desc_anchor_jitter_px"]
-                )
-            elif ch in style["punct_letters"]:
-                py = baseline_y - style["punct_anchor_px"] + random.randint(
-                    *style["punct_anchor_jitter_px"]
-                )
-            else:
-                py = baseline_y - h
-
-            letters_layer.paste(img, (cx, py), img)
-            cx += advance
-
-    save_page(letters_layer, page_number)
     print("Готово")
 
 # =====================================================
@@ -312,14 +1145,20 @@ if __name__ == "__main__":
         exit()
 
     style = load_style(cfg)
+    seed = style["seed"] if style["seed"] is not None else new_seed()
 
-    print("Введите текст. /accept — начать")
+    print("Введите текст. /accept — начать, "
+          f"/preview — предпросмотр {PREVIEW_DPI} DPI (стиль перечитывается)")
     lines = []
     while True:
         l = input()
+        if l.strip() == "/preview":
+            style = load_style(cfg)
+            render("\n".join(lines), style, seed, PREVIEW_DPI, PREVIEW_DIR)
+            continue
         if l.strip() == "/accept":
             print("Обработка...")
             break
         lines.append(l)
 
-    render("\n".join(lines), style)
\ No newline at end of file
+    render("\n".join(lines), load_style(cfg), seed)
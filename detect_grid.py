@@ -9,14 +9,20 @@ detect_grid.py — поиск сетки на отсканированном л
   debug/<page>/segments.png
   debug/<page>/cells.png
   debug/<page>/cells.json   ← JSON с координатами клеток + категория + формат
+
+Если на листе есть угловые метки шаблона (CreateModel.py, FIDUCIALS),
+сетка вычисляется по ним напрямую, без морфологии; masked.png и
+grid_lines.png тогда не пишутся.
 """
 
 import os
 import math
 import cv2
 import json
+import queue
+import threading
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageSequence
 import tkinter as tk
 from tkinter import filedialog
 
@@ -26,12 +32,49 @@ from tkinter import filedialog
 # ============================================================
 DEBUG_ROOT = "debug"
 
-ASSUME_DPI = 300
+ASSUME_DPI = 300              # если DPI не удалось ни прочитать, ни оценить
+CELL_SIZE_MM = 15.0            # как CELL_SIZE в Создание макетов/CreateModel.py
+MIN_DPI, MAX_DPI = 100, 2400   # диапазон поиска шага клетки
+META_DPI_TOLERANCE = 0.15      # расхождение DPI из файла с оценкой по сетке
+MIN_PITCH_PEAK = 0.2           # минимальная высота пика автокорреляции
+
 MIN_LINE_LEN_CM = 6.0          # минимальная длина линии
 GRID_DILATE = 2
 EDGE_CROP_RATIO = 0.02
 SEGMENT_THR_RATIO = 0.25
-MIN_SEGMENT_WIDTH_PX = 2
+MIN_SEGMENT_WIDTH_MM = 0.17    # 2 px при 300 DPI
+MIN_CELL_MM = 0.34             # 4 px при 300 DPI
+
+ANGLE_METHOD = "projection"    # "projection" | "hough"
+PROJ_WORK_WIDTH = 1000         # ширина уменьшенной маски для projection
+PROJ_MAX_ANGLE = 5.0           # диапазон поиска, ±градусы
+PROJ_COARSE_STEP = 0.5
+PROJ_FINE_STEP = 0.02
+
+# Разметка листа из Создание макетов/CreateModel.py, мм
+PAGE_W_MM, PAGE_H_MM = 210.0, 297.0   # A4
+GRID_MARGIN_MM = 10.0                 # MARGIN_X / MARGIN_Y
+ROWS_PER_COLUMN = 18                  # столько клеток помещается по высоте
+FIDUCIAL_SIZE_MM = 4.0
+FIDUCIAL_OFFSET_MM = 4.0
+
+# Код страницы (CreateModel.py, PAGE_CODE): 22 точки в нижнем поле
+PAGE_CODE_X_MM = 73.5          # центр первой точки от левого края
+PAGE_CODE_Y_MM = 6.0           # центр точек от нижнего края
+PAGE_CODE_PITCH_MM = 3.0
+PAGE_CODE_BITS = 22
+PAGE_CODE_SAMPLE_MM = 1.0      # сторона окна, по которому читается точка
+CATEGORIES = ["russian", "english", "symbols"]   # порядок групп шаблона
+
+FIDUCIAL_WORK_WIDTH = 800      # ширина уменьшенного листа для поиска меток
+FIDUCIAL_DARK = 100            # метки печатаются чёрным
+FIDUCIAL_CORNER_RATIO = 0.15   # метка ищется в этой доле листа у угла
+FIDUCIAL_MIN_FILL = 0.75
+FIDUCIAL_TOLERANCE = 0.05      # допуск на пропорции четырёхугольника меток
+
+PDF_RENDER_DPI = 300           # DPI растеризации страниц PDF
+PAGE_PREFETCH = 1              # сколько страниц декодировать наперёд
+PREFETCH_POLL = 0.1            # с, как часто фоновый поток проверяет остановку
 
 
 # ============================================================
@@ -55,20 +98,149 @@ def load_image_cv(path):
     return img
 
 
+def mm_to_px(mm, dpi):
+    return mm * dpi / 25.4
+
+
+def metadata_dpi(info):
+    """DPI из метаданных PIL (info["dpi"]) или None."""
+    dpi = info.get("dpi")
+    if isinstance(dpi, (tuple, list)):
+        dpi = dpi[0]
+    try:
+        dpi = float(dpi)
+    except (TypeError, ValueError):
+        return None
+    return dpi if dpi > 0 else None
+
+
+def read_dpi(path):
+    try:
+        with Image.open(path) as im:
+            return metadata_dpi(im.info)
+    except OSError:
+        return None
+
+
+def pil_to_bgr(page):
+    return cv2.cvtColor(np.asarray(page.convert("RGB")), cv2.COLOR_RGB2BGR)
+
+
+def iter_pages(path):
+    """Постранично: (имя страницы, BGR-изображение, номер или None, DPI или None).
+
+    Многостраничные TIFF и PDF декодируются по одной странице, так что
+    в памяти не лежит весь файл целиком.
+    """
+    base = os.path.splitext(os.path.basename(path))[0]
+    ext = os.path.splitext(path)[1].lower()
+
+    if ext == ".pdf":
+        try:
+            import pymupdf
+        except ImportError:
+            raise RuntimeError("Для PDF нужен PyMuPDF: pip install pymupdf")
+
+        zoom = PDF_RENDER_DPI / 72
+        with pymupdf.open(path) as doc:
+            single = doc.page_count == 1
+            for i, page in enumerate(doc):
+                pix = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom))
+                rgb = np.frombuffer(pix.samples, np.uint8).reshape(pix.h, pix.w, pix.n)
+                img = cv2.cvtColor(rgb[:, :, :3], cv2.COLOR_RGB2BGR)
+                if single:
+                    yield base, img, i, PDF_RENDER_DPI
+                else:
+                    yield f"{base}_p{i + 1:03d}", img, i, PDF_RENDER_DPI
+        return
+
+    if ext in (".tif", ".tiff"):
+        with Image.open(path) as im:
+            n_frames = getattr(im, "n_frames", 1)
+            if n_frames > 1:
+                for i, page in enumerate(ImageSequence.Iterator(im)):
+                    yield (f"{base}_p{i + 1:03d}", pil_to_bgr(page), i,
+                           metadata_dpi(page.info))
+                return
+
+    yield base, load_image_cv(path), None, read_dpi(path)
+
+
+def prefetch(iterable, depth=PAGE_PREFETCH):
+    """Следующие элементы готовятся в фоновом потоке, пока текущий
+    обрабатывается; в очереди не больше depth готовых страниц.
+
+    Если потребитель остановился раньше (break, исключение), поток
+    перестаёт читать, закрывает источник и завершается."""
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=PREFETCH_POLL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        it = iter(iterable)
+        try:
+            for item in it:
+                if not put(item):
+                    break
+            else:
+                put(done)
+        except Exception as e:
+            put(e)
+        finally:
+            if hasattr(it, "close"):
+                it.close()
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = q.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
 def filter_grid_lines(mask, min_len_px):
-    """Удаляет короткие линии, не являющиеся сеткой."""
-    out = np.zeros_like(mask)
-    cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    """Удаляет короткие линии, не являющиеся сеткой.
+
+    Отбор делается по статистике компонент в NumPy, поэтому время не
+    зависит от количества мелкого мусора на скане: цикл идёт только по
+    оставленным линиям, и таблица меток применяется в их рамках.
+    """
+    n, labels, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(
+        mask, 8, cv2.CV_32S, cv2.CCL_BBDT
+    )
 
-    for c in cnts:
-        x, y, w, h = cv2.boundingRect(c)
-        if w >= min_len_px or h >= min_len_px:
-            cv2.drawContours(out, [c], -1, 255, -1)
+    keep = (
+        (stats[:, cv2.CC_STAT_WIDTH] >= min_len_px)
+        | (stats[:, cv2.CC_STAT_HEIGHT] >= min_len_px)
+    )
+    keep[0] = False  # фон
+
+    lut = np.where(keep, 255, 0).astype(np.uint8)
+    out = np.zeros_like(mask)
+    for x, y, w, h, _ in stats[keep]:
+        out[y:y + h, x:x + w] |= lut[labels[y:y + h, x:x + w]]
 
     return out
 
 
-def find_segments(mask, axis=0, thr_ratio=SEGMENT_THR_RATIO, min_w=MIN_SEGMENT_WIDTH_PX):
+def find_segments(mask, axis=0, thr_ratio=SEGMENT_THR_RATIO, min_w=2):
     """Поиск вертикальных/горизонтальных линий по сумме проекций."""
     proj = np.sum(mask > 0, axis=axis)
     if proj.max() == 0:
@@ -99,7 +271,7 @@ def find_segments(mask, axis=0, thr_ratio=SEGMENT_THR_RATIO, min_w=MIN_SEGMENT_W
     return segs
 
 
-def estimate_angle(mask):
+def estimate_angle_hough(mask):
     """Оценка наклона сетки через Hough."""
     edges = cv2.Canny(mask, 50, 150)
     lines = cv2.HoughLinesP(edges, 1, np.pi / 180, 80,
@@ -123,6 +295,53 @@ def estimate_angle(mask):
     return med
 
 
+def projection_score(small, angle):
+    """Чем резче пики сумм по строкам и столбцам, тем ровнее сетка."""
+    h, w = small.shape[:2]
+    M = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    rot = cv2.warpAffine(small, M, (w, h), flags=cv2.INTER_LINEAR, borderValue=0)
+    rows = rot.sum(axis=1, dtype=np.float64)
+    cols = rot.sum(axis=0, dtype=np.float64)
+    return rows.var() + cols.var()
+
+
+def estimate_angle_projection(mask):
+    """Оценка наклона по проекционному профилю на уменьшенной маске.
+
+    Угол ищется грубым, затем всё более мелким перебором вокруг лучшего
+    значения; возвращается в той же системе, что и Hough (для warpAffine).
+    """
+    h, w = mask.shape[:2]
+    k = min(1.0, PROJ_WORK_WIDTH / w)
+    small = cv2.resize(mask, (max(1, int(w * k)), max(1, int(h * k))),
+                       interpolation=cv2.INTER_AREA)
+
+    if not small.any():
+        return 0.0
+
+    best = 0.0
+    lo, hi, step = -PROJ_MAX_ANGLE, PROJ_MAX_ANGLE, PROJ_COARSE_STEP
+
+    while True:
+        angles = np.arange(lo, hi + step / 2, step)
+        scores = [projection_score(small, a) for a in angles]
+        best = float(angles[int(np.argmax(scores))])
+
+        if step <= PROJ_FINE_STEP:
+            break
+        lo, hi = best - step, best + step
+        step = max(PROJ_FINE_STEP, step / 5)
+
+    return best
+
+
+def estimate_angle(mask, method=None):
+    method = method or ANGLE_METHOD
+    if method == "projection":
+        return estimate_angle_projection(mask)
+    return estimate_angle_hough(mask)
+
+
 def mask_crop_border(mask, crop_ratio=EDGE_CROP_RATIO):
     """Обнуляет края маски, чтобы игнорировать границы."""
     h, w = mask.shape[:2]
@@ -137,64 +356,213 @@ def mask_crop_border(mask, crop_ratio=EDGE_CROP_RATIO):
     return m
 
 
-# ============================================================
-# ФУНКЦИЯ ЗАПРОСА КАТЕГОРИИ И ФОРМАТА
-# ============================================================
-def ask_user_options():
-    print("Выберите категорию:")
-    categories = ["russian", "english", "symbols"]
-    for i, c in enumerate(categories, 1):
-        print(f"{i}. {c}")
+def grid_pitch(profile, dpi_range=(MIN_DPI, MAX_DPI)):
+    """Шаг сетки (px) по автокорреляции проекции линий или None."""
+    p = profile.astype(np.float64)
+    p -= p.mean()
+    n = len(p)
+
+    spec = np.fft.rfft(p, 2 * n)
+    ac = np.fft.irfft(spec * np.conj(spec))[:n]
+    if ac[0] <= 0:
+        return None
+
+    lo = int(mm_to_px(CELL_SIZE_MM, dpi_range[0]))
+    hi = min(n - 1, int(mm_to_px(CELL_SIZE_MM, dpi_range[1])))
+    if hi <= lo:
+        return None
+
+    lag = lo + int(np.argmax(ac[lo:hi + 1]))
+    if ac[lag] < MIN_PITCH_PEAK * ac[0]:
+        return None
+    return lag
+
+
+def estimate_dpi(horiz, vert):
+    """DPI по шагу клеток: известно, что клетка — CELL_SIZE_MM."""
+    pitches = [
+        p for p in (
+            grid_pitch(vert.sum(axis=0, dtype=np.float64)),
+            grid_pitch(horiz.sum(axis=1, dtype=np.float64)),
+        )
+        if p is not None
+    ]
+    if not pitches:
+        return None
+    return float(np.mean(pitches)) * 25.4 / CELL_SIZE_MM
+
+
+def choose_dpi(meta_dpi, est_dpi):
+    """DPI из файла точнее, но ему верим, только если он согласуется с сеткой
+    (JPEG часто несут значения по умолчанию вроде 72)."""
+    if meta_dpi and (est_dpi is None
+                     or abs(meta_dpi - est_dpi) <= META_DPI_TOLERANCE * est_dpi):
+        return meta_dpi
+    return est_dpi or ASSUME_DPI
+
+
+def fiducial_centers_mm():
+    """Центры меток в мм от левого верхнего угла: ЛВ, ПВ, ПН, ЛН."""
+    c = FIDUCIAL_OFFSET_MM + FIDUCIAL_SIZE_MM / 2
+    return np.float32([
+        [c, c], [PAGE_W_MM - c, c],
+        [PAGE_W_MM - c, PAGE_H_MM - c], [c, PAGE_H_MM - c],
+    ])
+
+
+def refine_center(gray, cx, cy, half):
+    """Центр масс тёмного пятна в окне полного разрешения."""
+    H, W = gray.shape
+    x0, y0 = max(0, int(cx - half)), max(0, int(cy - half))
+    x1, y1 = min(W, int(cx + half)), min(H, int(cy + half))
+    roi = gray[y0:y1, x0:x1]
+    m = cv2.moments((roi < FIDUCIAL_DARK).astype(np.uint8), binaryImage=True)
+    if m["m00"] == 0:
+        return cx, cy
+    return x0 + m["m10"] / m["m00"], y0 + m["m01"] / m["m00"]
+
+
+def find_fiducials(img):
+    """Четыре угловые метки (ЛВ, ПВ, ПН, ЛН) в пикселях или None."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    H, W = gray.shape
+    k = min(1.0, FIDUCIAL_WORK_WIDTH / W)
+    small = cv2.resize(gray, (max(1, int(W * k)), max(1, int(H * k))),
+                       interpolation=cv2.INTER_AREA)
+    h, w = small.shape
+
+    dark = (small < FIDUCIAL_DARK).astype(np.uint8)
+    n, _, stats, centroids = cv2.connectedComponentsWithStats(dark, connectivity=8)
+
+    bw = stats[:, cv2.CC_STAT_WIDTH].astype(np.float64)
+    bh = stats[:, cv2.CC_STAT_HEIGHT].astype(np.float64)
+    fill = stats[:, cv2.CC_STAT_AREA] / np.maximum(bw * bh, 1)
+
+    # лист примерно занимает скан целиком — отсюда ожидаемый размер метки
+    side = FIDUCIAL_SIZE_MM / PAGE_W_MM * w
+    ok = (
+        (fill >= FIDUCIAL_MIN_FILL)
+        & (bw > side / 2) & (bw < side * 2)
+        & (bh > side / 2) & (bh < side * 2)
+        & (np.abs(bw - bh) < 0.3 * np.maximum(bw, bh))
+    )
+    ok[0] = False
 
-    while True:
-        try:
-            c = int(input("Введите номер категории: "))
-            if 1 <= c <= len(categories):
-                category = categories[c-1]
-                break
-        except:
-            pass
-        print("Некорректный ввод, попробуйте ещё раз.")
+    cx, cy = centroids[:, 0], centroids[:, 1]
+    rx, ry = w * FIDUCIAL_CORNER_RATIO, h * FIDUCIAL_CORNER_RATIO
 
-    print("\nВыберите формат:")
-    formats = ["1-11", "2-6", "3-4"]
-    for i, f in enumerate(formats, 1):
-        print(f"{i}. {f}")
+    points = []
+    for corner_x, corner_y in ((0, 0), (w, 0), (w, h), (0, h)):
+        near = ok & (np.abs(cx - corner_x) < rx) & (np.abs(cy - corner_y) < ry)
+        idx = np.flatnonzero(near)
+        if len(idx) == 0:
+            return None
+        best = idx[np.argmin(np.hypot(cx[idx] - corner_x, cy[idx] - corner_y))]
+        points.append(refine_center(gray, cx[best] / k, cy[best] / k, side / k))
 
-    while True:
-        try:
-            f = int(input("Введите номер формата: "))
-            if 1 <= f <= len(formats):
-                format_value = formats[f-1]
-                break
-        except:
-            pass
-        print("Некорректный ввод, попробуйте ещё раз.")
+    pts = np.float32(points)
 
-    return category, format_value
+    # стороны четырёхугольника должны повторять пропорции шаблона
+    ref = fiducial_centers_mm()
+    def sides(q):
+        return np.linalg.norm(q - np.roll(q, -1, axis=0), axis=1)
+    ratio = sides(pts) / sides(ref)
+    if np.ptp(ratio) > FIDUCIAL_TOLERANCE * ratio.mean():
+        return None
 
+    return pts
 
-# ============================================================
-# ОСНОВНАЯ ЛОГИКА
-# ============================================================
-def process_image(path, category, format_value):
-    base = os.path.splitext(os.path.basename(path))[0]
-    out_dir = os.path.join(DEBUG_ROOT, base)
-    ensure_dir(out_dir)
 
-    print(f"\n=== Обрабатываю изображение: {path} ===")
+def read_page_code(img, pts):
+    """Код страницы по найденным меткам: {"category", "format", "page"} или None."""
+    Hm = cv2.getPerspectiveTransform(fiducial_centers_mm(), pts)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    H, W = gray.shape
+
+    xs = PAGE_CODE_X_MM + PAGE_CODE_PITCH_MM * np.arange(PAGE_CODE_BITS)
+    ys = np.full_like(xs, PAGE_H_MM - PAGE_CODE_Y_MM)
+    centers = cv2.perspectiveTransform(
+        np.dstack((xs, ys)).astype(np.float32), Hm
+    )[0]
+
+    dpi = np.linalg.norm(pts[1] - pts[0]) / (
+        fiducial_centers_mm()[1, 0] - fiducial_centers_mm()[0, 0]) * 25.4
+    half = max(1, int(mm_to_px(PAGE_CODE_SAMPLE_MM, dpi) / 2))
+
+    word = 0
+    for cx, cy in centers:
+        x, y = int(round(cx)), int(round(cy))
+        if not (half <= x < W - half and half <= y < H - half):
+            return None
+        dark = gray[y - half:y + half + 1, x - half:x + half + 1].mean() < FIDUCIAL_DARK
+        word = (word << 1) | int(dark)
+
+    # 1 | группа:2 | колонок:2 | клеток в колонке:4 | страница:8 | сумма:4 | 1
+    if word >> 21 != 1 or word & 1 != 1:
+        return None
+    payload = (word >> 5) & 0xFFFF
+    check = (word >> 1) & 0xF
+    if sum((payload >> s) & 0xF for s in (0, 4, 8, 12)) & 0xF != check:
+        return None
+
+    group = payload >> 14
+    if group >= len(CATEGORIES):
+        return None
+    ncols = (payload >> 12) & 0x3
+    per_col = (payload >> 8) & 0xF
+
+    return {
+        "category": CATEGORIES[group],
+        "format": f"{ncols}-{per_col}",
+        "page": payload & 0xFF,
+    }
+
+
+def locate_grid_fiducials(img, format_value, pts):
+    """Быстрый путь: сетка по угловым меткам и известной разметке листа.
+
+    Возвращает (angle, vert_coords, horiz_coords, dpi) в координатах
+    выровненного листа или None, если разметку не удалось построить.
+    """
+    try:
+        columns, per_col = map(int, format_value.split("-"))
+    except (AttributeError, ValueError):
+        return None
+
+    Hm = cv2.getPerspectiveTransform(fiducial_centers_mm(), pts)
+
+    n_cols = columns * per_col
+    n_rows = ROWS_PER_COLUMN
+    xs_mm = GRID_MARGIN_MM + CELL_SIZE_MM * np.arange(n_cols + 1)
+    ys_mm = GRID_MARGIN_MM + CELL_SIZE_MM * np.arange(n_rows + 1)
+    gx, gy = np.meshgrid(xs_mm, ys_mm)
+    lattice = np.dstack((gx, gy)).reshape(-1, 1, 2).astype(np.float32)
+    px = cv2.perspectiveTransform(lattice, Hm).reshape(n_rows + 1, n_cols + 1, 2)
+
+    # наклон верхней линии сетки — в той же системе, что и estimate_angle
+    dx, dy = px[0, -1] - px[0, 0]
+    angle = math.degrees(math.atan2(dy, dx))
 
-    # 1) загрузка
-    img = load_image_cv(path)
     H, W = img.shape[:2]
+    M = cv2.getRotationMatrix2D((W // 2, H // 2), angle, 1.0)
+    rot = cv2.transform(px.reshape(-1, 1, 2), M).reshape(n_rows + 1, n_cols + 1, 2)
+
+    vert_coords = [int(round(x)) for x in rot[:, :, 0].mean(axis=0)]
+    horiz_coords = [int(round(y)) for y in rot[:, :, 1].mean(axis=1)]
+
+    dpi = float(np.linalg.norm(pts[1] - pts[0])
+                / (fiducial_centers_mm()[1, 0] - fiducial_centers_mm()[0, 0]) * 25.4)
 
-    save_png(os.path.join(out_dir, "original.png"), img)
+    return angle, vert_coords, horiz_coords, dpi
+
+
+def line_masks(img):
+    """Горизонтальные и вертикальные линии листа (морфологическое открытие)."""
+    H, W = img.shape[:2]
 
-    # 2) преобразование
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     inv = cv2.bitwise_not(gray)
 
-    # 3) морфология
     kh = max(25, W // 120)
     kv = max(25, H // 120)
     kern_h = cv2.getStructuringElement(cv2.MORPH_RECT, (kh, 1))
@@ -203,8 +571,11 @@ def process_image(path, category, format_value):
     horiz = cv2.morphologyEx(inv, cv2.MORPH_OPEN, kern_h)
     vert  = cv2.morphologyEx(inv, cv2.MORPH_OPEN, kern_v)
 
-    min_len_px = int((MIN_LINE_LEN_CM * ASSUME_DPI) / 2.54)
+    return horiz, vert
 
+
+def build_grid(horiz, vert, min_len_px):
+    """Маска сетки: длинные линии обоих направлений, слегка утолщённые."""
     horiz_f = filter_grid_lines(horiz, min_len_px)
     vert_f  = filter_grid_lines(vert,  min_len_px)
 
@@ -214,6 +585,27 @@ def process_image(path, category, format_value):
         grid = cv2.dilate(grid, np.ones((3,3), np.uint8),
                           iterations=GRID_DILATE)
 
+    return grid
+
+
+def locate_grid_morphology(img, dpi, base, out_dir):
+    """Сетка по маскам линий: (angle, vert_coords, horiz_coords, dpi)."""
+    H, W = img.shape[:2]
+
+    # 3) преобразование и морфология
+    horiz, vert = line_masks(img)
+
+    # DPI: из файла, сверенный с шагом клеток; от него все пороги в px
+    est_dpi = estimate_dpi(horiz, vert)
+    dpi = choose_dpi(dpi, est_dpi)
+    print(f"[{base}] DPI: {dpi:.0f}"
+          + (f" (по сетке {est_dpi:.0f})" if est_dpi else ""))
+
+    min_len_px = int(mm_to_px(MIN_LINE_LEN_CM * 10, dpi))
+    min_seg_px = max(1, round(mm_to_px(MIN_SEGMENT_WIDTH_MM, dpi)))
+
+    grid = build_grid(horiz, vert, min_len_px)
+
     save_gray_png(os.path.join(out_dir, "masked.png"), grid)
     save_png(
         os.path.join(out_dir, "grid_lines.png"),
@@ -229,64 +621,137 @@ def process_image(path, category, format_value):
     angle = estimate_angle(grid_cropped)
     print(f"[{base}] Угол наклона: {angle:.2f}°")
 
-    # 6) поворот
+    # 6-7) поворот маски и поиск линий
     M = cv2.getRotationMatrix2D((W // 2, H // 2), angle, 1.0)
     grid_rot = cv2.warpAffine(grid, M, (W, H),
                               flags=cv2.INTER_NEAREST,
                               borderValue=0)
-    img_rot  = cv2.warpAffine(img, M, (W, H),
-                              flags=cv2.INTER_LINEAR,
-                              borderValue=(255,255,255))
-
-    # 7) повторная обработка
     grid_rot_cropped = mask_crop_border(grid_rot)
 
-    vert_segs  = find_segments(grid_rot_cropped, axis=0)
-    horiz_segs = find_segments(grid_rot_cropped, axis=1)
+    vert_segs  = find_segments(grid_rot_cropped, axis=0, min_w=min_seg_px)
+    horiz_segs = find_segments(grid_rot_cropped, axis=1, min_w=min_seg_px)
 
     print(f"[{base}] Линий найдено: vert={len(vert_segs)}, horiz={len(horiz_segs)}")
 
-    if len(vert_segs) < 2 or len(horiz_segs) < 2:
-        print(f"[{base}] Недостаточно линий, пробую fallback...")
+    vert_coords  = sorted([ (s+e)//2 for (s,e) in vert_segs ])
+    horiz_coords = sorted([ (s+e)//2 for (s,e) in horiz_segs ])
 
-        min_len2 = max(5, min_len_px // 2)
-        horiz2 = filter_grid_lines(horiz, min_len2)
-        vert2  = filter_grid_lines(vert,  min_len2)
+    return angle, vert_coords, horiz_coords, dpi
 
-        grid2 = cv2.bitwise_or(horiz2, vert2)
-        grid2 = cv2.dilate(grid2, np.ones((3,3), np.uint8),
-                           iterations=GRID_DILATE)
 
-        grid_rot = cv2.warpAffine(grid2, M, (W, H),
-                                  flags=cv2.INTER_NEAREST,
-                                  borderValue=0)
+# ============================================================
+# ФУНКЦИЯ ЗАПРОСА КАТЕГОРИИ И ФОРМАТА
+# ============================================================
+def ask_user_options():
+    print("Выберите категорию:")
+    categories = CATEGORIES
+    for i, c in enumerate(categories, 1):
+        print(f"{i}. {c}")
 
-        grid_rot_cropped = mask_crop_border(grid_rot)
+    while True:
+        try:
+            c = int(input("Введите номер категории: "))
+            if 1 <= c <= len(categories):
+                category = categories[c-1]
+                break
+        except:
+            pass
+        print("Некорректный ввод, попробуйте ещё раз.")
+
+    print("\nВыберите формат:")
+    formats = ["1-11", "2-6", "3-4"]
+    for i, f in enumerate(formats, 1):
+        print(f"{i}. {f}")
+
+    while True:
+        try:
+            f = int(input("Введите номер формата: "))
+            if 1 <= f <= len(formats):
+                format_value = formats[f-1]
+                break
+        except:
+            pass
+        print("Некорректный ввод, попробуйте ещё раз.")
 
-        vert_segs  = find_segments(grid_rot_cropped, axis=0)
-        horiz_segs = find_segments(grid_rot_cropped, axis=1)
+    return category, format_value
 
-        print(f"[{base}] После fallback: vert={len(vert_segs)}, horiz={len(horiz_segs)}")
+
+# ============================================================
+# ОСНОВНАЯ ЛОГИКА
+# ============================================================
+def process_image(path, category, format_value, img=None, page_name=None,
+                  page_index=None, dpi=None, ask_options=ask_user_options):
+    base = page_name or os.path.splitext(os.path.basename(path))[0]
+    out_dir = os.path.join(DEBUG_ROOT, base)
+    ensure_dir(out_dir)
+
+    print(f"\n=== Обрабатываю изображение: {path} ({base}) ===")
+
+    # 1) загрузка
+    if img is None:
+        img = load_image_cv(path)
+    H, W = img.shape[:2]
+
+    original_path = os.path.join(out_dir, "original.png")
+    save_png(original_path, img)
+
+    # страница многостраничного файла дальше читается из original.png
+    image_path = path if page_index is None else original_path
+
+    # 2) угловые метки и код страницы; человека спрашиваем, только если
+    #    кода нет, а категория и формат не заданы
+    pts = find_fiducials(img)
+    code = read_page_code(img, pts) if pts is not None else None
+    if code is not None:
+        category, format_value = code["category"], code["format"]
+        print(f"[{base}] Код страницы: {category}, {format_value}, "
+              f"страница {code['page'] + 1}")
+    elif category is None or format_value is None:
+        category, format_value = ask_options()
+
+    # быстрый путь: сетка по меткам; иначе — морфология
+    located = None
+    if pts is not None:
+        located = locate_grid_fiducials(img, format_value, pts)
+    if located is not None:
+        angle, vert_coords, horiz_coords, dpi = located
+        print(f"[{base}] Сетка по меткам: угол {angle:.2f}°, DPI {dpi:.0f}")
+    else:
+        if dpi is None and page_index is None:
+            dpi = read_dpi(path)
+        angle, vert_coords, horiz_coords, dpi = locate_grid_morphology(
+            img, dpi, base, out_dir
+        )
+
+    min_cell_px = max(1, round(mm_to_px(MIN_CELL_MM, dpi)))
+
+    # 6) поворот
+    M = cv2.getRotationMatrix2D((W // 2, H // 2), angle, 1.0)
+    img_rot  = cv2.warpAffine(img, M, (W, H),
+                              flags=cv2.INTER_LINEAR,
+                              borderValue=(255,255,255))
 
     # 9) клетки
     cells_vis = img_rot.copy()
     cells = []
+    cell_grid = []   # [строка][столбец] -> клетка или None (пропущена)
 
-    if len(vert_segs) >= 2 and len(horiz_segs) >= 2:
-
-        vert_coords  = sorted([ (s+e)//2 for (s,e) in vert_segs ])
-        horiz_coords = sorted([ (s+e)//2 for (s,e) in horiz_segs ])
+    if len(vert_coords) >= 2 and len(horiz_coords) >= 2:
 
         for yi in range(len(horiz_coords)-1):
             y0, y1 = horiz_coords[yi], horiz_coords[yi+1]
+            grid_row = []
+            cell_grid.append(grid_row)
 
             for xi in range(len(vert_coords)-1):
                 x0, x1 = vert_coords[xi], vert_coords[xi+1]
 
-                if (x1 - x0) < 4 or (y1 - y0) < 4:
+                if (x1 - x0) < min_cell_px or (y1 - y0) < min_cell_px:
+                    grid_row.append(None)
                     continue
 
                 cells.append((x0, y0, x1, y1))
+                grid_row.append((x0, y0, x1, y1))
                 cv2.rectangle(cells_vis, (x0, y0), (x1, y1),
                               (255, 0, 0), 2)
 
@@ -298,22 +763,28 @@ def process_image(path, category, format_value):
     json_path = os.path.join(out_dir, "cells.json")
 
     data = {
-        "image_path": os.path.abspath(path),
+        "image_path": os.path.abspath(image_path),
         "image_name": os.path.basename(path),
+        "source_path": os.path.abspath(path),
+        "source_page": page_index,
         "debug_dir": out_dir,
 
         "width": W,
         "height": H,
+        "dpi": dpi,
 
         "angle": angle,
-        "vert_lines":  [ (s+e)//2 for (s,e) in vert_segs ],
-        "horiz_lines": [ (s+e)//2 for (s,e) in horiz_segs ],
+        "vert_lines":  vert_coords,
+        "horiz_lines": horiz_coords,
 
         "cells": cells,
+        "grid": cell_grid,
 
         # Новые поля:
         "category": category,
-        "format": format_value
+        "format": format_value,
+        "template_page": code["page"] if code else None,
+        "rows_per_column": ROWS_PER_COLUMN if code else None,
     }
 
     with open(json_path, "w", encoding="utf-8") as f:
@@ -331,13 +802,19 @@ def main():
     root = tk.Tk()
     root.withdraw()
 
-    # 1) спрашиваем параметры
-    category, format_value = ask_user_options()
+    # 1) параметры спрашиваются только для листов без кода страницы,
+    #    один раз на запуск
+    answers = []
+
+    def ask_options():
+        if not answers:
+            answers.append(ask_user_options())
+        return answers[0]
 
     # 2) выбор файлов
     files = filedialog.askopenfilenames(
         title="Выберите изображения",
-        filetypes=[("Images", "*.jpg *.jpeg *.png *.bmp *.tif *.tiff")]
+        filetypes=[("Images / PDF", "*.jpg *.jpeg *.png *.bmp *.tif *.tiff *.pdf")]
     )
 
     if not files:
@@ -349,7 +826,12 @@ def main():
     # 3) обработка
     for f in files:
         try:
-            process_image(f, category, format_value)
+            for name, img, index, dpi in prefetch(iter_pages(f)):
+                try:
+                    process_image(f, None, None, img, name, index, dpi,
+                                  ask_options)
+                except Exception as e:
+                    print(f"Ошибка при обработке {name}: {e}")
         except Exception as e:
             print(f"Ошибка при обработке {f}: {e}")
 
@@ -3,6 +3,7 @@ import os
 import cv2
 import json
 import numpy as np
+from functools import lru_cache
 from PIL import Image
 import tkinter as tk
 from tkinter import filedialog
@@ -14,6 +15,30 @@ from tkinter import filedialog
 TARGET_SIZE = 400   # больше НЕ используется, оставлено для совместимости
 MIN_PIXELS_IN_CELL = 50
 PAD_BBOX = 4
+MIN_COMPONENT_AREA = 20
+
+# "cells" — порог и контуры отдельно в каждой клетке;
+# "page"  — одна бинаризация и connectedComponents на весь лист
+SEGMENT_MODE = "cells"
+
+# "otsu"     — свой порог Otsu в каждой клетке (как раньше);
+# "gaussian" — адаптивный порог по гауссову окну на весь лист;
+# "sauvola"  — порог Sauvola по локальным среднему и дисперсии на весь лист.
+# Глобальная бинаризация считается один раз на лист, клетки её только режут.
+BINARIZE_MODE = "otsu"
+BINARIZE_WINDOW = 101       # окно, px; заметно больше толщины штриха
+GAUSSIAN_C = 40            # меньше — на светлом фоне всплывает шум сканера
+SAUVOLA_K = 0.2
+SAUVOLA_R = 128
+
+# Режим "page": линии сетки вычитаются из бинаризации до разметки компонент
+GRID_LINE_RATIO = 0.8   # прямой штрих длиннее этой доли клетки — линия сетки
+GRID_LINE_BAND = 0.05   # линия ищется в полосе ± этой доли клетки от своей координаты
+GRID_LINE_DILATE = 1    # утолщение маски линий, чтобы снять их серую кайму
+
+# Имя извлечённой картинки: подчёркивание не даёт спутать номер с глифом
+# цифры (0.png … 9.png); символы номерам сопоставляет rename.py
+EXTRACTED_NAME = "_{:04d}.png"
 
 # =====================================================
 # HELPERS
@@ -22,9 +47,9 @@ PAD_BBOX = 4
 def ensure_dir(p):
     os.makedirs(p, exist_ok=True)
 
-def save_rgba(path, arr):
+def save_glyph(path, arr):
     ensure_dir(os.path.dirname(path))
-    Image.fromarray(arr).save(path)
+    Image.fromarray(arr, "LA").save(path)
 
 def clean_grid_inside(cell, grid_mask=None):
     if grid_mask is None:
@@ -33,12 +58,102 @@ def clean_grid_inside(cell, grid_mask=None):
     result[grid_mask > 0] = 255
     return result
 
-def extract_alpha_mask(cell):
-    blur = cv2.GaussianBlur(cell, (5, 5), 0)
+def otsu_binarize(gray):
+    blur = cv2.GaussianBlur(gray, (5, 5), 0)
     _, mask = cv2.threshold(
         blur, 0, 255,
         cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU
     )
+    return mask
+
+def sauvola_binarize(gray, window=BINARIZE_WINDOW, k=SAUVOLA_K, r=SAUVOLA_R):
+    """T = m * (1 + k * (s / R - 1)); m, s — среднее и СКО в окне."""
+    g = gray.astype(np.float32)
+    mean = cv2.boxFilter(g, -1, (window, window), borderType=cv2.BORDER_REPLICATE)
+    sq = cv2.boxFilter(g * g, -1, (window, window), borderType=cv2.BORDER_REPLICATE)
+
+    # дисперсия и порог считаются на месте, чтобы не держать лишние копии
+    np.subtract(sq, mean * mean, out=sq)
+    np.maximum(sq, 0, out=sq)
+    np.sqrt(sq, out=sq)
+    sq *= k / r
+    sq += 1 - k
+    mean *= sq
+    del sq
+
+    return np.where(g <= mean, 255, 0).astype(np.uint8)
+
+def binarize_page(gray, mode=BINARIZE_MODE):
+    """Бинаризация всего листа: чернила — 255, фон — 0."""
+    if mode == "otsu":
+        return otsu_binarize(gray)
+    if mode == "gaussian":
+        return cv2.adaptiveThreshold(
+            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+            cv2.THRESH_BINARY_INV, BINARIZE_WINDOW, GAUSSIAN_C
+        )
+    if mode == "sauvola":
+        return sauvola_binarize(gray)
+    raise ValueError(f"Неизвестный режим бинаризации: {mode}")
+
+def grid_region(shape, vert_lines, horiz_lines):
+    """Прямоугольник сетки плюс полклетки на вылеты штрихов."""
+    xs = np.asarray(sorted(vert_lines))
+    ys = np.asarray(sorted(horiz_lines))
+    if len(xs) < 2 or len(ys) < 2:
+        return 0, 0, shape[1], shape[0]
+
+    cell_w = np.median(np.diff(xs))
+    cell_h = np.median(np.diff(ys))
+
+    ox = max(0, int(xs[0] - cell_w / 2))
+    oy = max(0, int(ys[0] - cell_h / 2))
+    ex = min(shape[1], int(xs[-1] + cell_w / 2))
+    ey = min(shape[0], int(ys[-1] + cell_h / 2))
+    return ox, oy, ex, ey
+
+def load_page(path, angle, mode=BINARIZE_MODE, lines=None):
+    """Выровненный лист в градациях серого и (кроме "otsu") его бинаризация.
+
+    lines = (vert_lines, horiz_lines) ограничивает бинаризацию областью
+    сетки; вне её маска нулевая. Результат кэшируется, поэтому повторная
+    обработка того же листа не считает поворот и порог заново; время
+    изменения и размер файла входят в ключ, так что перезаписанный скан
+    читается снова.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    return _load_page(path, (st.st_mtime_ns, st.st_size), angle, mode, lines)
+
+@lru_cache(maxsize=1)
+def _load_page(path, stamp, angle, mode, lines):
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None, None
+
+    if angle != 0:
+        H, W = img.shape
+        M = cv2.getRotationMatrix2D((W // 2, H // 2), angle, 1.0)
+        img = cv2.warpAffine(img, M, (W, H), borderValue=255)
+
+    if mode == "otsu":
+        return img, None
+
+    if lines is not None:
+        ox, oy, ex, ey = grid_region(img.shape, *lines)
+    else:
+        ox, oy, ex, ey = 0, 0, img.shape[1], img.shape[0]
+
+    binary = np.zeros_like(img)
+    binary[oy:ey, ox:ex] = binarize_page(img[oy:ey, ox:ex], mode)
+    return img, binary
+
+def extract_alpha_mask(cell, mask=None):
+    """mask — готовый срез бинаризации листа; без него — Otsu по клетке."""
+    if mask is None:
+        mask = otsu_binarize(cell)
 
     cnts, hier = cv2.findContours(
         mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE
@@ -56,6 +171,105 @@ def extract_alpha_mask(cell):
 
     return alpha
 
+def remove_grid_lines(binary, xs, ys, cell_w, cell_h):
+    """Бинаризация без линий сетки. xs, ys — координаты линий в той же
+    системе, что и binary; в полосе вокруг каждой линия выделяется
+    морфологическим открытием ядром почти в клетку и вычитается."""
+    kern_h = cv2.getStructuringElement(
+        cv2.MORPH_RECT, (max(3, int(GRID_LINE_RATIO * cell_w)), 1)
+    )
+    kern_v = cv2.getStructuringElement(
+        cv2.MORPH_RECT, (1, max(3, int(GRID_LINE_RATIO * cell_h)))
+    )
+
+    lines = np.zeros_like(binary)
+    H, W = binary.shape
+
+    half = max(2, int(GRID_LINE_BAND * cell_w))
+    for x in xs:
+        x0, x1 = max(0, int(x) - half), min(W, int(x) + half + 1)
+        if x0 < x1:
+            lines[:, x0:x1] |= cv2.morphologyEx(binary[:, x0:x1],
+                                                cv2.MORPH_OPEN, kern_v)
+
+    half = max(2, int(GRID_LINE_BAND * cell_h))
+    for y in ys:
+        y0, y1 = max(0, int(y) - half), min(H, int(y) + half + 1)
+        if y0 < y1:
+            lines[y0:y1] |= cv2.morphologyEx(binary[y0:y1],
+                                             cv2.MORPH_OPEN, kern_h)
+
+    if GRID_LINE_DILATE > 0:
+        lines = cv2.dilate(lines, np.ones((3, 3), np.uint8),
+                           iterations=GRID_LINE_DILATE)
+
+    return cv2.bitwise_and(binary, cv2.bitwise_not(lines))
+
+def segment_page(img, vert_lines, horiz_lines, binary=None):
+    """Сегментация всего листа за один проход.
+
+    Лист бинаризуется один раз, компоненты связности относятся к клетке
+    по центру масс. Возвращает {(строка, столбец): (x0, y0, alpha)}, где
+    alpha — маска глифа в окне, охватывающем все его компоненты (штрих
+    может немного заходить в соседнюю клетку). binary — готовая
+    бинаризация листа; без неё область сетки порогуется по Otsu.
+
+    Линии сетки убираются до разметки компонент: буква, задевшая линию,
+    иначе срослась бы с ней и ушла в брак вместе с сеткой.
+    """
+    xs = np.asarray(sorted(vert_lines))
+    ys = np.asarray(sorted(horiz_lines))
+    n_cols = len(xs) - 1
+    n_rows = len(ys) - 1
+    if n_cols < 1 or n_rows < 1:
+        return {}
+
+    # обрабатывается только область сетки
+    cell_w = np.median(np.diff(xs))
+    cell_h = np.median(np.diff(ys))
+    ox, oy, ex, ey = grid_region(img.shape, xs, ys)
+
+    if binary is None:
+        binary = otsu_binarize(img[oy:ey, ox:ex])
+    else:
+        binary = binary[oy:ey, ox:ex]
+    binary = remove_grid_lines(binary, xs - ox, ys - oy, cell_w, cell_h)
+
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(
+        binary, connectivity=8
+    )
+
+    col = np.searchsorted(xs, centroids[:, 0] + ox) - 1
+    row = np.searchsorted(ys, centroids[:, 1] + oy) - 1
+
+    keep = (
+        (stats[:, cv2.CC_STAT_AREA] >= MIN_COMPONENT_AREA)
+        & (col >= 0) & (col < n_cols)
+        & (row >= 0) & (row < n_rows)
+        # что осталось от сетки (пересечения, обрывки) — длиннее полутора клеток
+        & (stats[:, cv2.CC_STAT_WIDTH] < 1.5 * cell_w)
+        & (stats[:, cv2.CC_STAT_HEIGHT] < 1.5 * cell_h)
+    )
+    keep[0] = False  # фон
+
+    cell_id = np.where(keep, row * n_cols + col, -1)
+
+    result = {}
+    for cid in np.unique(cell_id[cell_id >= 0]):
+        comps = np.flatnonzero(cell_id == cid)
+        x0 = stats[comps, cv2.CC_STAT_LEFT].min()
+        y0 = stats[comps, cv2.CC_STAT_TOP].min()
+        x1 = (stats[comps, cv2.CC_STAT_LEFT] + stats[comps, cv2.CC_STAT_WIDTH]).max()
+        y1 = (stats[comps, cv2.CC_STAT_TOP] + stats[comps, cv2.CC_STAT_HEIGHT]).max()
+
+        lut = np.zeros(n, np.uint8)
+        lut[comps] = 255
+        alpha = lut[labels[y0:y1, x0:x1]]
+
+        result[divmod(int(cid), n_cols)] = (int(x0) + ox, int(y0) + oy, alpha)
+
+    return result
+
 # =====================================================
 # ✨ ИЗМЕНЕНА ТОЛЬКО ЭТА ФУНКЦИЯ ✨
 # =====================================================
@@ -78,12 +292,9 @@ def cut_and_resize(cell, alpha):
     if cut.size == 0:
         return None
 
-    # GRAY → RGBA, БЕЗ масштабирования
-    rgb = cv2.cvtColor(cut, cv2.COLOR_GRAY2BGR)
-    rgba = cv2.cvtColor(rgb, cv2.COLOR_BGR2BGRA)
-    rgba[:, :, 3] = a
-
-    return rgba
+    # GRAY + ALPHA (LA), БЕЗ масштабирования;
+    # цвет чернил добавляется только при рендере
+    return np.dstack((cut, a))
 
 # =====================================================
 # SYMBOL EXTRACTOR
@@ -104,6 +315,38 @@ class SymbolExtractor:
             self.next_index[category] = 1
         self.next_index[category] += delta
 
+    def group_rows(self, cells):
+        """Группировка плоского списка клеток в строки по центру по y."""
+        rows = []
+        for c in cells:
+            x0, y0, x1, y1 = c
+            center = (y0 + y1) // 2
+            rows.append((center, c))
+        rows.sort(key=lambda x: x[0])
+
+        heights = [abs(c[3] - c[1]) for _, c in rows] if rows else [0]
+        avg_h = int(np.median(heights)) if heights else 0
+        thr = max(10, avg_h // 2) if avg_h > 0 else 20
+
+        rows_grouped = []
+        current = []
+        last = None
+
+        for cy, c in rows:
+            if last is None or abs(cy - last) < thr:
+                current.append(c)
+            else:
+                rows_grouped.append(current)
+                current = [c]
+            last = cy
+        if current:
+            rows_grouped.append(current)
+
+        for i in range(len(rows_grouped)):
+            rows_grouped[i] = sorted(rows_grouped[i], key=lambda c: c[0])
+
+        return rows_grouped
+
     def process_page(self, json_path):
         print(f"[+] Обработка JSON: {json_path}")
 
@@ -115,17 +358,17 @@ class SymbolExtractor:
             print("[-] Не найдено изображение:", page_img_path)
             return
 
-        img = cv2.imread(page_img_path, cv2.IMREAD_GRAYSCALE)
+        lines = None
+        if "vert_lines" in data and "horiz_lines" in data:
+            lines = (tuple(data["vert_lines"]), tuple(data["horiz_lines"]))
+
+        img, binary = load_page(
+            page_img_path, data.get("angle", 0), BINARIZE_MODE, lines
+        )
         if img is None:
             print("[-] Не удалось загрузить изображение:", page_img_path)
             return
 
-        angle = data.get("angle", 0)
-        if angle != 0:
-            H, W = img.shape
-            M = cv2.getRotationMatrix2D((W // 2, H // 2), angle, 1.0)
-            img = cv2.warpAffine(img, M, (W, H), borderValue=255)
-
         cells = data.get("cells", [])
         category = data.get("category", "symbols")
         fmt = data.get("format", "1-11")
@@ -141,42 +384,34 @@ class SymbolExtractor:
             print("[-] per_col должен быть >= 2.")
             return
 
-        # -------- группировка по строкам --------
-
-        rows = []
-        for c in cells:
-            x0, y0, x1, y1 = c
-            center = (y0 + y1) // 2
-            rows.append((center, c))
-        rows.sort(key=lambda x: x[0])
-
-        heights = [abs(c[3] - c[1]) for _, c in rows] if rows else [0]
-        avg_h = int(np.median(heights)) if heights else 0
-        thr = max(10, avg_h // 2) if avg_h > 0 else 20
-
-        rows_grouped = []
-        current = []
-        last = None
+        # -------- строки клеток --------
 
-        for cy, c in rows:
-            if last is None or abs(cy - last) < thr:
-                current.append(c)
-            else:
-                rows_grouped.append(current)
-                current = [c]
-            last = cy
-        if current:
-            rows_grouped.append(current)
+        # новая разметка: готовая матрица [строка][столбец], None — пропуск;
+        # старые cells.json без неё группируются по y, как раньше
+        rows_grouped = data.get("grid")
+        if rows_grouped is None:
+            rows_grouped = self.group_rows(cells)
 
         if not rows_grouped:
             print("[-] Не найдены строки.")
             return
 
-        for i in range(len(rows_grouped)):
-            rows_grouped[i] = sorted(rows_grouped[i], key=lambda c: c[0])
-
         rows_count = len(rows_grouped)
-        base_number = self._get_next_base(category)
+
+        # лист шаблона с кодом страницы нумеруется по своему месту в группе,
+        # так что порядок обработки листов не важен
+        template_page = data.get("template_page")
+        if template_page is not None:
+            rows_count = max(rows_count, data.get("rows_per_column") or 0)
+            base_number = 1 + template_page * columns * rows_count
+        else:
+            base_number = self._get_next_base(category)
+
+        segments = None
+        if SEGMENT_MODE == "page" and "grid" in data:
+            segments = segment_page(
+                img, data["vert_lines"], data["horiz_lines"], binary
+            )
 
         # -------- основной обход --------
 
@@ -190,10 +425,25 @@ class SymbolExtractor:
                     if idx_in_row < 0 or idx_in_row >= len(row_cells):
                         continue
 
-                    x0, y0, x1, y1 = row_cells[idx_in_row]
-                    raw = img[y0:y1, x0:x1]
+                    cell = row_cells[idx_in_row]
+                    if cell is None:
+                        continue
+
+                    if segments is not None:
+                        seg = segments.get((r, idx_in_row))
+                        if seg is None:
+                            continue
+                        x0, y0, alpha = seg
+                        raw = img[y0:y0 + alpha.shape[0],
+                                  x0:x0 + alpha.shape[1]]
+                    else:
+                        x0, y0, x1, y1 = cell
+                        raw = img[y0:y1, x0:x1]
+                        alpha = extract_alpha_mask(
+                            raw,
+                            None if binary is None else binary[y0:y1, x0:x1]
+                        )
 
-                    alpha = extract_alpha_mask(raw)
                     if cv2.countNonZero(alpha) < MIN_PIXELS_IN_CELL:
                         continue
 
@@ -207,10 +457,16 @@ class SymbolExtractor:
                     ensure_dir(out_dir)
 
                     number = base_number + col * rows_count + r
-                    out_path = os.path.join(out_dir, f"{number}.png")
-                    save_rgba(out_path, result)
-
-        self._advance_base(category, columns * rows_count)
+                    out_path = os.path.join(out_dir, EXTRACTED_NAME.format(number))
+                    save_glyph(out_path, result)
+
+        if template_page is not None:
+            self.next_index[category] = max(
+                self._get_next_base(category),
+                base_number + columns * rows_count
+            )
+        else:
+            self._advance_base(category, columns * rows_count)
         print("[+] Готово.")
 
 # =====================================================
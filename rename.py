@@ -1,4 +1,6 @@
 import os
+import re
+import json
 
 rus = list(
     "АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЭЮЯ" +
@@ -22,6 +24,14 @@ category_map = {
 }
 
 ROOT = "letters"
+MANIFEST_NAME = "manifest.json"
+
+# Извлечённые картинки: _0001.png (extract_letters.EXTRACTED_NAME).
+# Старые номерные 1.png, 2.png ... понимаются только там, где цифры
+# не бывают именами глифов — в symbols 0.png … 9.png это сами цифры.
+EXTRACTED_RE = re.compile(r"^_(\d+)\.png$")
+LEGACY_RE = re.compile(r"^(\d+)\.png$")
+GLYPH_FILE_RE = re.compile(r"^(.+?)(?:_(\d{2}))?\.png$")
 
 SYMBOL_NAME_MAP = {
     ".": "dot", ",": "comma", "!": "excl", "?": "q",
@@ -49,71 +59,136 @@ def symbol_to_filename(char):
     return SYMBOL_NAME_MAP.get(char, f"u{ord(char):04X}")
 
 
-def rename_in_category(category_name, symbols_list):
-    category_path = os.path.join(ROOT, category_name)
-    if not os.path.isdir(category_path):
-        return
+def glyph_base_name(category_name, char):
+    if category_name == "symbols":
+        return symbol_to_filename(char)
+    return apply_suffix_if_needed(category_name, char)
 
-    for font_folder in os.listdir(category_path):
-        font_path = os.path.join(category_path, font_folder)
-        if not os.path.isdir(font_path):
+
+def extracted_number(filename, legacy):
+    """Номер извлечённой картинки или None, если это уже имя глифа."""
+    m = EXTRACTED_RE.match(filename) or (legacy and LEGACY_RE.match(filename))
+    return int(m.group(1)) if m else None
+
+
+def build_manifest(category_name, font_folder, files, symbols_list):
+    """Сопоставляет номера извлечённых картинок символам.
+
+    Ключ glyph — то имя, которое раньше получал файл при переименовании
+    (А, аl, dot, А_02 ...), так что anchors.json и рендер работают
+    одинаково с переименованными и с номерными файлами.
+    Файлы с именами глифов не трогаются, поэтому повторный запуск
+    на уже разобранной папке ничего не меняет.
+    """
+    glyphs = {}
+    counters = {}
+
+    legacy = not any(
+        glyph_base_name(category_name, c).isdigit() for c in symbols_list
+    )
+    numbered = []
+    for f in files:
+        number = extracted_number(f, legacy)
+        if number is not None:
+            numbered.append((number, f))
+            continue
+        # варианты продолжают уже переименованные файлы (5.png, 5_02.png ...)
+        m = GLYPH_FILE_RE.match(f)
+        if m:
+            variant = int(m.group(2)) if m.group(2) else 1
+            counters[m.group(1)] = max(counters.get(m.group(1), 0), variant)
+    numbered.sort()
+
+    for number, filename in numbered:
+        index = number - 1
+        if index < 0 or index >= len(symbols_list):
             continue
 
-        files = sorted(os.listdir(font_path))
+        char = symbols_list[index]
+        base = glyph_base_name(category_name, char)
 
-        temp_map = []  # (temp_name, final_name)
+        counters[base] = counters.get(base, 0) + 1
+        variant = counters[base]
 
-        # ---------- PASS 1: во временные имена ----------
-        for filename in files:
-            name, ext = os.path.splitext(filename)
-            if not name.isdigit():
-                continue
+        glyphs[str(number)] = {
+            "file": filename,
+            "char": char,
+            "name": base,
+            "variant": variant,
+            "glyph": base if variant == 1 else f"{base}_{variant:02d}",
+        }
 
-            index = int(name) - 1
-            if index < 0 or index >= len(symbols_list):
-                continue
+    return {
+        "category": category_name,
+        "font": font_folder,
+        "glyphs": glyphs,
+    }
 
-            char = symbols_list[index]
 
-            if category_name == "symbols":
-                base = symbol_to_filename(char)
-            else:
-                base = apply_suffix_if_needed(category_name, char)
+def check_manifest(category_name, manifest, files, symbols_list):
+    """Файлы с именем глифа (5.png, dot.png, аl.png) должны остаться своими.
 
-            temp_name = f"__tmp__{filename}"
-            temp_map.append((temp_name, f"{base}{ext}"))
+    Возвращает список ошибок: файл, который манифест отдал бы чужому символу.
+    """
+    claimed = {e["file"]: e["name"] for e in manifest["glyphs"].values()}
+    errors = []
+    for char in symbols_list:
+        name = glyph_base_name(category_name, char)
+        filename = name + ".png"
+        if filename in files and claimed.get(filename, name) != name:
+            errors.append(f"{filename} → {claimed[filename]!r}, а не {char!r}")
+    return errors
 
-            os.rename(
-                os.path.join(font_path, filename),
-                os.path.join(font_path, temp_name)
-            )
 
-        # ---------- PASS 2: во финальные имена ----------
-        counters = {}
+def write_manifest(font_path, manifest):
+    # атомарно: либо старый манифест, либо новый целиком
+    path = os.path.join(font_path, MANIFEST_NAME)
+    tmp = path + ".tmp"
 
-        for temp_name, final_name in temp_map:
-            base, ext = os.path.splitext(final_name)
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
 
-            counters.setdefault(base, 0)
-            counters[base] += 1
+    os.replace(tmp, path)
+    return path
 
-            if counters[base] == 1:
-                out_name = final_name
-            else:
-                out_name = f"{base}_{counters[base]:02d}{ext}"
 
-            os.rename(
-                os.path.join(font_path, temp_name),
-                os.path.join(font_path, out_name)
-            )
+def index_category(category_name, symbols_list):
+    """Вместо переименования файлов пишет manifest.json в каждую папку шрифта."""
+    category_path = os.path.join(ROOT, category_name)
+    if not os.path.isdir(category_path):
+        return
+
+    for font_folder in sorted(os.listdir(category_path)):
+        font_path = os.path.join(category_path, font_folder)
+        if not os.path.isdir(font_path):
+            continue
+
+        files = os.listdir(font_path)
+        manifest = build_manifest(
+            category_name, font_folder, files, symbols_list
+        )
+
+        errors = check_manifest(category_name, manifest, files, symbols_list)
+        if errors:
+            print(f"{font_path}: манифест не записан: " + "; ".join(errors))
+            continue
+
+        if not manifest["glyphs"]:
+            # старый манифест от прежней схемы имён только путал бы рендер
+            stale = os.path.join(font_path, MANIFEST_NAME)
+            if os.path.exists(stale):
+                os.remove(stale)
+                print(f"{stale}: удалён, номерных файлов нет")
+            continue
 
-            print(f"{temp_name} → {out_name}")
+        path = write_manifest(font_path, manifest)
+        print(f"{path}: {len(manifest['glyphs'])} глифов")
 
 
 def main():
     for category, symbols_list in category_map.items():
         print(f"\n=== Обрабатываю: {category} ===")
-        rename_in_category(category, symbols_list)
+        index_category(category, symbols_list)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+"""
+render_server.py — тёплый сервер рендера рукописных страниц.
+
+Держит в памяти декодированные глифы и разобранные стили, принимает
+задания по HTTP (TCP или Unix-сокет) и отдаёт страницы по мере готовности.
+
+  POST /render   {"text": "...", "style": "acc", "seed": 42, "dpi": 300}
+                 → application/x-ndjson, по строке на страницу:
+                   {"page": 1, "letters": "...", "full": "..."}
+                   последняя строка: {"done": true, "seed": 42, "pages": N,
+                                      "missing": {"символ": сколько раз}}
+  GET  /styles   → список доступных стилей
+
+Если очередь заданий заполнена, сервер сразу отвечает 503, на неверный
+запрос — 400. Если страница не удалась, последняя строка —
+{"done": true, "error": "..."}, а файлы задания удаляются.
+Если клиент отключился, задание отменяется и его файлы тоже удаляются.
+Готовые страницы лежат в JOBS_DIR/<id> не дольше JOB_TTL секунд —
+клиент должен забрать их за это время.
+"""
+
+import os
+import json
+import uuid
+import time
+import shutil
+import asyncio
+import argparse
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+
+import create
+
+
+# ============================================================
+# НАСТРОЙКИ
+# ============================================================
+CONFIGS_DIR = "configs"
+JOBS_DIR = os.path.join(create.OUTPUT_DIR, "jobs")
+
+HOST = "127.0.0.1"
+PORT = 8765
+WORKERS = 2                 # каждая страница в работе — ~1 ГБ памяти
+QUEUE_SIZE = 8
+MAX_BODY_BYTES = 1 << 20
+JOB_TTL = 60 * 60           # сек.: столько хранятся файлы готового задания
+CLEANUP_INTERVAL = 5 * 60   # сек.: как часто удаляются устаревшие задания
+
+
+# ============================================================
+# СТИЛИ
+# ============================================================
+def load_styles(configs_dir=CONFIGS_DIR):
+    """Стили доступны и по имени файла, и по полю name из YAML."""
+    styles = {}
+    for f in sorted(os.listdir(configs_dir)):
+        stem, ext = os.path.splitext(f)
+        if ext.lower() not in (".yaml", ".yml"):
+            continue
+
+        path = os.path.join(configs_dir, f)
+        style = create.load_style(path)
+        styles[stem] = style
+
+        with open(path, "r", encoding="utf-8") as fh:
+            name = (yaml.safe_load(fh) or {}).get("name")
+        if name:
+            styles.setdefault(name, style)
+
+    return styles
+
+
+# ============================================================
+# СЕРВЕР
+# ============================================================
+class RenderServer:
+
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE, job_ttl=JOB_TTL):
+        self.styles = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = asyncio.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.job_ttl = job_ttl
+        self.active = set()     # id заданий в очереди и в работе
+
+    def warm(self):
+        self.styles = load_styles()
+        glyphs = create.warm_glyphs()
+        print(f"Стилей: {len(self.styles)}, глифов в памяти: {glyphs}")
+
+    # ---------- выполнение заданий ----------
+
+    def _render_and_save(self, lines, style, page_number, out_dir, dpi):
+        letters_layer = create.render_page(lines, style, dpi)
+        return create.save_page(letters_layer, page_number, out_dir,
+                                style["output"], style["ink_color"], dpi)
+
+    async def run_job(self, job):
+        loop = asyncio.get_running_loop()
+        style, seed, out_dir = job["style"], job["seed"], job["out_dir"]
+
+        futures = []
+        try:
+            pages = await loop.run_in_executor(
+                self.executor, create.layout_pages, job["text"], style, seed
+            )
+
+            # страницы независимы (seed), поэтому рендерятся параллельно,
+            # а отдаются клиенту по порядку
+            futures = [
+                loop.run_in_executor(
+                    self.executor, self._render_and_save,
+                    lines, style, i + 1, out_dir, job["dpi"]
+                )
+                for i, lines in enumerate(pages)
+            ]
+
+            for i, fut in enumerate(futures):
+                letters_path, full_path = await fut
+                await job["results"].put(
+                    {"page": i + 1, "letters": letters_path, "full": full_path}
+                )
+        except BaseException:
+            # не начатые страницы отменяются, начатые дожидаются —
+            # иначе их файлы появятся уже после очистки
+            for fut in futures:
+                fut.cancel()
+            await asyncio.gather(*futures, return_exceptions=True)
+            shutil.rmtree(out_dir, ignore_errors=True)
+            raise
+
+        missing = create.missing_glyphs(job["text"])
+        await job["results"].put(
+            {"done": True, "seed": seed, "pages": len(pages), "missing": missing}
+        )
+
+    def cancel_job(self, job):
+        """Клиент ушёл: задание в очереди пропускается, а у выполняющегося
+        отменяются не начатые страницы (см. run_job)."""
+        job["cancelled"] = True
+        if job["task"] is None:
+            return
+        if job["task"].done():
+            # всё отрисовано, но клиент не дочитал — файлы никто не заберёт
+            shutil.rmtree(job["out_dir"], ignore_errors=True)
+        else:
+            job["task"].cancel()
+
+    async def worker(self):
+        while True:
+            job = await self.jobs.get()
+            try:
+                if job["cancelled"]:
+                    shutil.rmtree(job["out_dir"], ignore_errors=True)
+                    continue
+                job["task"] = asyncio.ensure_future(self.run_job(job))
+                await job["task"]
+            except asyncio.CancelledError:
+                if not job["cancelled"]:
+                    raise
+                # задание могло быть отменено ещё до первого шага run_job
+                shutil.rmtree(job["out_dir"], ignore_errors=True)
+            except Exception as e:
+                await job["results"].put({"done": True, "error": str(e)})
+            finally:
+                self.active.discard(job["id"])
+                self.jobs.task_done()
+
+    # ---------- хранение результатов ----------
+
+    def cleanup_jobs(self, active, ttl):
+        """Удаляет папки заданий, не менявшиеся дольше ttl секунд,
+        кроме заданий из active. Возвращает число удалённых."""
+        if not os.path.isdir(JOBS_DIR):
+            return 0
+
+        now = time.time()
+        removed = 0
+        for job_id in os.listdir(JOBS_DIR):
+            if job_id in active:
+                continue
+            path = os.path.join(JOBS_DIR, job_id)
+            try:
+                expired = now - os.path.getmtime(path) > ttl
+            except OSError:
+                continue
+            if expired:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        return removed
+
+    async def janitor(self, interval=CLEANUP_INTERVAL):
+        # удаление файлов не должно ждать в очереди за рендером страниц
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.run_in_executor(
+                None, self.cleanup_jobs, set(self.active), self.job_ttl
+            )
+            await asyncio.sleep(interval)
+
+    # ---------- HTTP ----------
+
+    async def read_request(self, reader):
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        method, path, _ = lines[0].split(" ", 2)
+
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                k, v = line.split(":", 1)
+                headers[k.strip().lower()] = v.strip()
+
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_BYTES:
+            raise ValueError("слишком большой запрос")
+        body = await reader.readexactly(length) if length else b""
+
+        return method, path, body
+
+    async def send_json(self, writer, status, obj):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + data
+        )
+        await writer.drain()
+
+    async def wait_disconnect(self, reader):
+        # запрос уже прочитан целиком, дальше клиент только ждёт ответа:
+        # конец потока значит, что он закрыл соединение
+        try:
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+
+    async def stream_results(self, reader, writer, results):
+        """Отдаёт страницы по мере готовности. Если клиент отключился,
+        бросает ConnectionResetError, не дожидаясь следующей страницы."""
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/x-ndjson; charset=utf-8\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+
+        gone = asyncio.ensure_future(self.wait_disconnect(reader))
+        try:
+            while True:
+                get = asyncio.ensure_future(results.get())
+                await asyncio.wait(
+                    {get, gone}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not get.done():
+                    get.cancel()
+                    raise ConnectionResetError("клиент отключился")
+
+                item = get.result()
+                line = (json.dumps(item, ensure_ascii=False) + "\n").encode("utf-8")
+                writer.write(f"{len(line):X}\r\n".encode("latin-1") + line + b"\r\n")
+                await writer.drain()
+                if item.get("done"):
+                    break
+        finally:
+            gone.cancel()
+
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    def make_job(self, body):
+        """Задание из тела запроса. Ошибки формы запроса — ValueError
+        (ответ 400), неизвестный стиль — KeyError (404)."""
+        req = json.loads(body or b"{}")
+        if not isinstance(req, dict):
+            raise ValueError("тело запроса должно быть объектом JSON")
+
+        text = req.get("text")
+        if not isinstance(text, str):
+            raise ValueError("поле text обязательно")
+
+        style_name = req.get("style", "acc")
+        if not isinstance(style_name, str):
+            raise ValueError("поле style должно быть строкой")
+        if style_name not in self.styles:
+            raise KeyError(style_name)
+
+        options = req.get("options", {})
+        if not isinstance(options, dict):
+            raise ValueError("поле options должно быть объектом")
+
+        # опции задания перекрывают поля стиля, не трогая общий стиль
+        style = dict(self.styles[style_name])
+        for k, v in options.items():
+            try:
+                if k == "output":
+                    if not isinstance(v, dict):
+                        raise ValueError("options.output должно быть объектом")
+                    style[k] = create.parse_output({**style[k], **v})
+                elif k == "missing_glyph":
+                    style[k] = create.parse_missing(v)
+                elif k in style:
+                    style[k] = tuple(v) if isinstance(v, list) else v
+            except (TypeError, AttributeError) as e:
+                raise ValueError(f"неверное значение options.{k}") from e
+
+        seed = req.get("seed", style.get("seed"))
+        if seed is None:
+            seed = create.new_seed()
+        elif isinstance(seed, bool) or not isinstance(seed, (int, str)):
+            raise ValueError("seed должен быть целым числом или строкой")
+
+        dpi = req.get("dpi", create.DPI)
+        if isinstance(dpi, bool) or not isinstance(dpi, int):
+            raise ValueError("dpi должен быть целым числом")
+        if not 0 < dpi <= create.DPI:
+            raise ValueError(f"dpi должен быть в диапазоне 1..{create.DPI}")
+
+        job_id = uuid.uuid4().hex
+        out_dir = os.path.join(JOBS_DIR, job_id)
+        create.ensure_output_dir(out_dir)
+
+        return {
+            "id": job_id,
+            "text": text,
+            "style": style,
+            "seed": seed,
+            "dpi": dpi,
+            "out_dir": out_dir,
+            "results": asyncio.Queue(),
+            "cancelled": False,
+            "task": None,
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, body = await self.read_request(reader)
+
+            if method == "GET" and path == "/styles":
+                await self.send_json(writer, "200 OK", sorted(self.styles))
+
+            elif method == "POST" and path == "/render":
+                try:
+                    job = self.make_job(body)
+                except KeyError as e:
+                    await self.send_json(writer, "404 Not Found",
+                                         {"error": f"нет стиля {e}"})
+                    return
+                except ValueError as e:
+                    await self.send_json(writer, "400 Bad Request",
+                                         {"error": str(e)})
+                    return
+
+                try:
+                    self.jobs.put_nowait(job)
+                except asyncio.QueueFull:
+                    shutil.rmtree(job["out_dir"], ignore_errors=True)
+                    await self.send_json(writer, "503 Service Unavailable",
+                                         {"error": "очередь заполнена"})
+                    return
+                self.active.add(job["id"])
+
+                try:
+                    await self.stream_results(reader, writer, job["results"])
+                except BaseException:
+                    # результат больше некому отдавать — не занимаем пул
+                    self.cancel_job(job)
+                    raise
+
+            else:
+                await self.send_json(writer, "404 Not Found", {"error": path})
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.LimitOverrunError:
+            await self.send_json(writer, "400 Bad Request",
+                                 {"error": "слишком длинные заголовки"})
+        except ValueError as e:
+            await self.send_json(writer, "400 Bad Request", {"error": str(e)})
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def serve(self, host=HOST, port=PORT, unix_path=None):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.warm)
+
+        for _ in range(self.workers):
+            asyncio.create_task(self.worker())
+        asyncio.create_task(self.janitor())
+
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle, path=unix_path)
+            print(f"Сервер слушает {unix_path}")
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print(f"Сервер слушает http://{host}:{port}")
+
+        async with server:
+            await server.serve_forever()
+
+
+# ============================================================
+# MAIN
+# ============================================================
+def main():
+    parser = argparse.ArgumentParser(description="Сервер рендера страниц")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--unix", help="путь к Unix-сокету вместо TCP")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--queue", type=int, default=QUEUE_SIZE)
+    parser.add_argument("--job-ttl", type=int, default=JOB_TTL,
+                        help="сколько секунд хранить файлы готовых заданий")
+    args = parser.parse_args()
+
+    server = RenderServer(workers=args.workers, queue_size=args.queue,
+                          job_ttl=args.job_ttl)
+    asyncio.run(server.serve(args.host, args.port, args.unix))
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,21 @@ CELL_SIZE = 15     # мм
 MARGIN_X = 10      # мм
 MARGIN_Y = 10      # мм
 FONT_NAME = "Calibri"
+
+# Угловые метки: чёрные квадраты в полях, по ним detect_grid сразу
+# восстанавливает положение сетки (значения продублированы там же)
+FIDUCIALS = True
+FIDUCIAL_SIZE = 4      # мм, сторона квадрата
+FIDUCIAL_OFFSET = 4    # мм, от края листа до квадрата
+
+# Код страницы: ряд точек в нижнем поле между метками — группа, номер
+# страницы в группе и раскладка (колонок, клеток в колонке). Формат кода
+# продублирован в detect_grid.read_page_code
+PAGE_CODE = True
+PAGE_CODE_X = 73.5     # мм, центр первой точки от левого края
+PAGE_CODE_Y = 6        # мм, центр точек от нижнего края
+PAGE_CODE_PITCH = 3    # мм
+PAGE_CODE_DOT = 2      # мм
 # -------------------------------------------
 
 mm = 72 / 25.4
@@ -35,14 +50,50 @@ groups = [
     ("Цифры и символы", digits + symbols, 2, 3),
 ]
 
+def draw_fiducials(c, width, height):
+    if not FIDUCIALS:
+        return
+
+    size = FIDUCIAL_SIZE * mm
+    off = FIDUCIAL_OFFSET * mm
+    c.setFillColor(colors.black)
+    for x in (off, width - off - size):
+        for y in (off, height - off - size):
+            c.rect(x, y, size, size, stroke=0, fill=1)
+
+def page_code_bits(group, page, ncols, per_col):
+    """1 | группа:2 | колонок:2 | клеток в колонке:4 | страница:8 | сумма:4 | 1"""
+    payload = (group << 14) | (ncols << 12) | (per_col << 8) | page
+    check = sum((payload >> s) & 0xF for s in (0, 4, 8, 12)) & 0xF
+    word = (1 << 21) | (payload << 5) | (check << 1) | 1
+    return [(word >> (21 - i)) & 1 for i in range(22)]
+
+def draw_page_code(c, group, page, ncols, per_col):
+    if not PAGE_CODE:
+        return
+
+    dot = PAGE_CODE_DOT * mm
+    c.setFillColor(colors.black)
+    for i, bit in enumerate(page_code_bits(group, page, ncols, per_col)):
+        if bit:
+            cx = (PAGE_CODE_X + i * PAGE_CODE_PITCH) * mm
+            cy = PAGE_CODE_Y * mm
+            c.rect(cx - dot / 2, cy - dot / 2, dot, dot, stroke=0, fill=1)
+
+def start_page(c, width, height, group, page, ncols, copies):
+    draw_fiducials(c, width, height)
+    draw_page_code(c, group, page, ncols, copies + 1)
+
 def draw_template(filename="letters_template.pdf"):
     c = canvas.Canvas(filename, pagesize=A4)
     width, height = A4
 
-    for _, symbols, copies, ncols in groups:
+    for group, (_, symbols, copies, ncols) in enumerate(groups):
         x = margin_x_pt
         y = height - margin_y_pt - cell_pt
         col_count = 0
+        page = 0
+        start_page(c, width, height, group, page, ncols, copies)
 
         for s in symbols:
             # эталон
@@ -70,6 +121,8 @@ def draw_template(filename="letters_template.pdf"):
                 else:
                     # новая страница
                     c.showPage()
+                    page += 1
+                    start_page(c, width, height, group, page, ncols, copies)
                     x = margin_x_pt
                     y = height - margin_y_pt - cell_pt
                     col_count = 0